@@ -0,0 +1,62 @@
+"""Compares the JSON and columnar exports of tracking data.
+
+Runs without a database, on rows built in memory in the shape pymongo
+returns them. Reports payload sizes and the time a client takes to parse
+each payload.
+
+    python bench/export.py [number_of_points]
+"""
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from bson import ObjectId  # noqa
+from encoders import dumps  # noqa
+from export import decode_points, encode_points  # noqa
+from models import serialize_points, zone_cache  # noqa
+
+
+def make_rows(count):
+    zone_ids = [ObjectId() for _ in range(100)]
+    started = 1487000000000
+    return [{
+        '_id': ObjectId(),
+        'tracking_id': 'phone{}'.format(i % 1000),
+        'data_type': 'track',
+        'zone_id': zone_ids[i % len(zone_ids)],
+        'lat': 49.8350957 + i * 1e-6,
+        'lon': 24.0206744 - i * 1e-6,
+        'tracking_timestamp': started + i * 100,
+        'created_at': datetime.now()
+    } for i in range(count)]
+
+
+def main(count):
+    zone_cache._zones, zone_cache._names = [], {}
+    zone_cache.ttl = float('inf')
+    rows = make_rows(count)
+
+    json_payload = dumps(
+        {'data': list(serialize_points(rows)), 'status': 'success'})
+    columnar_payload = encode_points(rows)
+
+    json_time = min(timeit.repeat(
+        lambda: json.loads(json_payload), number=1, repeat=3))
+    columnar_time = min(timeit.repeat(
+        lambda: decode_points(columnar_payload), number=1, repeat=3))
+    print('points:         {}'.format(count))
+    print('json:           {:.1f}KB, parsed in {:.3f}s'.format(
+        len(json_payload) / 1024.0, json_time))
+    print('columnar:       {:.1f}KB, parsed in {:.3f}s'.format(
+        len(columnar_payload) / 1024.0, columnar_time))
+    print('size ratio:     {:.1f}x'.format(
+        len(json_payload) / float(len(columnar_payload))))
+    print('parse speedup:  {:.1f}x'.format(json_time / columnar_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
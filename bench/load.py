@@ -0,0 +1,216 @@
+"""Load test of the ingest and query endpoints of a running app.
+
+Creates a synthetic fleet of zones and devices, optionally seeds tracking
+points through /v1/bulk_tracking, then drives every scenario with
+`--concurrency` threads and prints latency percentiles and throughput as
+JSON. Zones are reused across runs, but seeded and ingested points pile
+up, so start from an empty database to compare runs, e.g.
+
+    gunicorn -w 4 --pythonpath src app:app &
+    python bench/load.py --seed-points 1000000 --concurrency 32 > run.json
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib2
+
+from datetime import datetime
+
+LVIV = (49.8397, 24.0297)
+ZONE_TYPES = ('control', 'checkpoint')
+DATA_TYPES = ('track',) * 8 + ('enter', 'leave')
+SCENARIOS = ('tracking', 'bulk_tracking', 'zones', 'tracking_data')
+
+
+def call(url, method='GET', payload=None):
+    headers = {}
+    data = None
+    if payload is not None:
+        data = json.dumps(payload)
+        headers['Content-Type'] = 'application/json'
+    req = urllib2.Request(url, data, headers)
+    req.get_method = lambda: method
+    res = urllib2.urlopen(req)
+    return res.getcode(), res.read()
+
+
+class Fleet(object):
+    """Deterministic generator of zones, devices and their points."""
+
+    def __init__(self, url, devices, zones, seed):
+        self.url = url
+        self.random = random.Random(seed)
+        self.devices = ['device{:06d}'.format(i) for i in range(devices)]
+        self.zone_count = zones
+        self.zones = []
+        self.timestamp = int(time.time() * 1000)
+        self._lock = threading.Lock()
+
+    def create_zones(self):
+        """Creates the fleet's zones, reusing those of earlier runs.
+
+        Zones are matched by name, so repeated runs against the same
+        database keep measuring the same `--zones` zones.
+        """
+        _, body = call(self.url + '/v1/zones')
+        existing = {zone['name']: zone for zone in json.loads(body)['data']}
+        for i in range(self.zone_count):
+            zone = {
+                'name': 'zone{}'.format(i),
+                'zone_type': self.random.choice(ZONE_TYPES),
+                'lat': LVIV[0] + self.random.uniform(-0.1, 0.1),
+                'lon': LVIV[1] + self.random.uniform(-0.1, 0.1),
+                'radius': self.random.randint(20, 500)
+            }
+            if zone['name'] in existing:
+                zone = existing[zone['name']]
+            else:
+                _, body = call(self.url + '/v1/zones', 'POST', zone)
+                zone = json.loads(body)['data']
+            self.zones.append((zone['id'], zone['lat'], zone['lon']))
+
+    def point(self):
+        with self._lock:
+            self.timestamp += 1
+            timestamp = self.timestamp
+            zone_id, lat, lon = self.random.choice(self.zones)
+            return {
+                'tracking_id': self.random.choice(self.devices),
+                'data_type': self.random.choice(DATA_TYPES),
+                'zone_id': zone_id,
+                'tracking_timestamp': timestamp,
+                'lat': lat + self.random.uniform(-0.001, 0.001),
+                'lon': lon + self.random.uniform(-0.001, 0.001)
+            }
+
+    def points(self, count):
+        return [self.point() for _ in range(count)]
+
+    def device(self):
+        with self._lock:
+            return self.random.choice(self.devices)
+
+
+def percentile(latencies, p):
+    """Nearest-rank percentile of sorted latencies."""
+    if not latencies:
+        return None
+    index = max(int(math.ceil(p / 100.0 * len(latencies))) - 1, 0)
+    return latencies[index]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def run(operation, requests, concurrency):
+    """Calls `operation` `requests` times from `concurrency` threads."""
+    latencies, errors = [], []
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            started = time.time()
+            try:
+                operation()
+            except Exception as ex:
+                with lock:
+                    errors.append(str(ex))
+            else:
+                latency = time.time() - started
+                with lock:
+                    latencies.append(latency)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': round(elapsed, 3),
+        'ops_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': milliseconds(percentile(latencies, 50)),
+        'p95_ms': milliseconds(percentile(latencies, 95)),
+        'p99_ms': milliseconds(percentile(latencies, 99)),
+        'max_ms': milliseconds(latencies[-1] if latencies else None)
+    }
+
+
+def seed(fleet, count, batch_size, concurrency):
+    batches = int(math.ceil(count / float(batch_size)))
+    return run(lambda: call(fleet.url + '/v1/bulk_tracking', 'POST', {
+        'data': fleet.points(batch_size)
+    }), batches, concurrency)
+
+
+def scenarios(fleet, args):
+    url = fleet.url
+    return {
+        'tracking': lambda: call(
+            url + '/v1/tracking', 'POST', fleet.point()),
+        'bulk_tracking': lambda: call(
+            url + '/v1/bulk_tracking', 'POST',
+            {'data': fleet.points(args.batch_size)}),
+        'zones': lambda: call(url + '/v1/zones'),
+        'tracking_data': lambda: call(
+            '{}/v1/tracking-data/{}?page_size={}'.format(
+                url, fleet.device(), args.page_size))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--zones', type=int, default=300)
+    parser.add_argument('--seed-points', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per scenario')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='points per bulk_tracking and seed request')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run, all by default')
+    parser.add_argument('--random-seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fleet = Fleet(args.url, args.devices, args.zones, args.random_seed)
+    fleet.create_zones()
+
+    report = {
+        'started_at': datetime.utcnow().isoformat() + 'Z',
+        'config': vars(args),
+        'scenarios': {}
+    }
+    if args.seed_points:
+        report['seed'] = seed(
+            fleet, args.seed_points, args.batch_size, args.concurrency)
+
+    operations = scenarios(fleet, args)
+    for name in args.scenario or SCENARIOS:
+        report['scenarios'][name] = run(
+            operations[name], args.requests, args.concurrency)
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Compares `Tracking.as_dict` with the raw-row `serialize_points` path.
+
+Runs without a database: rows are built in memory in the shape pymongo
+returns them, so only the per-row work done in the worker is measured.
+
+    python bench/serialization.py [number_of_points]
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from bson import ObjectId  # noqa
+from mongoengine.queryset import QuerySet  # noqa
+from models import Tracking, serialize_points, zone_cache  # noqa
+
+
+def make_rows(count):
+    zone_ids = [ObjectId() for _ in range(100)]
+    started = 1487000000000
+    return [{
+        '_id': ObjectId(),
+        'tracking_id': 'phone{}'.format(i % 1000),
+        'data_type': 'track',
+        'zone_id': zone_ids[i % len(zone_ids)],
+        'lat': 49.8350957,
+        'lon': 24.0206744,
+        'tracking_timestamp': started + i * 100,
+        'created_at': datetime.now()
+    } for i in range(count)]
+
+
+def main(count):
+    # Keep zone names out of the picture: both paths share the same cache.
+    zone_cache._zones, zone_cache._names = [], {}
+    zone_cache.ttl = float('inf')
+    rows = make_rows(count)
+    queryset = QuerySet(Tracking, None).only(
+        *Tracking.serialized_fields).as_pymongo()
+
+    def hydrate():
+        return [Tracking._from_son(row).as_dict() for row in rows]
+
+    def raw():
+        return list(serialize_points(
+            queryset._get_as_pymongo(row) for row in rows))
+
+    assert hydrate() == raw()
+
+    hydrate_time = min(timeit.repeat(hydrate, number=1, repeat=3))
+    raw_time = min(timeit.repeat(raw, number=1, repeat=3))
+    print('points:         {}'.format(count))
+    print('as_dict:        {:.3f}s'.format(hydrate_time))
+    print('as_pymongo:     {:.3f}s'.format(raw_time))
+    print('speedup:        {:.1f}x'.format(hydrate_time / raw_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
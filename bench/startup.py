@@ -0,0 +1,52 @@
+"""Measures the cold start of a worker.
+
+Every run is a fresh interpreter, as a new gunicorn worker without
+`--preload` would be. Reports the time to import `app`, and the time of
+the first and second request to each path, the first one paying for the
+Mongo connection and anything else done lazily.
+
+    python bench/startup.py [runs]
+"""
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+PATHS = ('/', '/v1/zones')
+
+WORKER = """
+import json, sys, time
+started = time.time()
+from app import app
+timings = {'import': time.time() - started}
+app.logger.disabled = True
+client = app.test_client()
+for path in %r:
+    for call in ('first', 'second'):
+        started = time.time()
+        client.get(path)
+        timings['{} {}'.format(call, path)] = time.time() - started
+json.dump(timings, sys.stdout)
+""" % (PATHS,)
+
+
+def measure():
+    output = subprocess.check_output(
+        [sys.executable, '-c', WORKER], cwd=SRC)
+    return json.loads(output)
+
+
+def main(runs):
+    results = [measure() for _ in range(runs)]
+    print('runs:                  {}'.format(runs))
+    names = ['import'] + sorted(set(results[0]) - {'import'})
+    for name in names:
+        timings = sorted(result[name] for result in results)
+        print('{:22} {:.1f}ms median, {:.1f}ms max'.format(
+            name + ':', timings[len(timings) // 2] * 1000,
+            timings[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,62 @@
+"""Compares compiled payload validators with the former `schema` ones.
+
+    python bench/validation.py [number_of_points]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from bson import ObjectId  # noqa
+from schema import Schema, And, Or, Use, Regex  # noqa
+from schemas import bulk_tracking_schema  # noqa
+
+legacy_tracking = {
+    'tracking_id': And(
+        basestring, len, error='tracking_id should be non-empty string'),
+    'zone_id': And(
+        basestring, len, error='zone_id should be non-empty string'),
+    'data_type': Regex(
+        '(enter|leave|track)',
+        error='possible data_type values are: enter, leave, track'),
+    'tracking_timestamp': Use(
+        int, error='tracking_timestamp should be integer'),
+    'lat': Or(int, float, error='lat should be either int or float'),
+    'lon': Or(int, float, error='lon should be either int or float')
+}
+
+legacy_bulk_tracking_schema = Schema({
+    'data': [legacy_tracking]
+})
+
+
+def make_payload(count):
+    return {'data': [{
+        u'tracking_id': u'phone{}'.format(i % 1000),
+        u'data_type': u'track',
+        u'zone_id': unicode(ObjectId()),
+        u'tracking_timestamp': 1487000000000 + i,
+        u'lat': 49.8350957,
+        u'lon': 24.0206744
+    } for i in range(count)]}
+
+
+def main(count):
+    payload = make_payload(count)
+    assert (bulk_tracking_schema.validate(payload)['data'] ==
+            (legacy_bulk_tracking_schema.validate(payload)['data'], []))
+
+    legacy_time = min(timeit.repeat(
+        lambda: legacy_bulk_tracking_schema.validate(payload),
+        number=1, repeat=3))
+    compiled_time = min(timeit.repeat(
+        lambda: bulk_tracking_schema.validate(payload), number=1, repeat=3))
+    print('points:         {}'.format(count))
+    print('schema:         {:.4f}s'.format(legacy_time))
+    print('compiled:       {:.4f}s'.format(compiled_time))
+    print('speedup:        {:.1f}x'.format(legacy_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -1,63 +1,202 @@
+import atexit
+import click
+import hashlib
 import os
-from flask import Flask, request
+import tempfile
+import time
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import (
+    Blueprint, Flask, Response, current_app, request, stream_with_context)
+from flask.cli import with_appcontext
 from flask_mongoengine import MongoEngine
-from helpers import api_response
-from models import Tracking, Zone
-from schemas import tracking_schema, bulk_tracking_schema, zone_schema
+from mongoengine import Q
+from mongoengine.connection import get_connection
+from mongoengine.queryset import QuerySet
+from schema import SchemaError
+from constants import Granularities
+from database import pool_stats, read_preference
+from encoders import dumps
+from export import encode_points
+from feed import events, newest_event_id
+from geo import distance
+from helpers import api_response, error_response, Envelope, encode_cursor
+from ingest import (
+    ingest, ingest_documents, validate_points, remove_duplicates)
+from metrics import (
+    finish_failed, record_unhandled, render as render_metrics)
+from models import (
+    Tracking, Zone, ZoneStats, Rollup, LastPosition, zone_cache,
+    serialize_points, ensure_indexes)
+from occupancy import rebuild_occupancy
+from partitions import (
+    collection_for, drop_partitions, ensure_partition_indexes,
+    move_to_partitions, tracking_points)
+from positions import rebuild_positions
+from retention import purge, purge_in_background, wipe
+from rollups import bucket_start, rebuild_rollups
+from schemas import (
+    tracking_schema, bulk_tracking_schema, zone_schema,
+    tracking_data_params_schema, zones_near_params_schema,
+    timeseries_params_schema, tracking_feed_params_schema,
+    tracking_data_delete_params_schema, positions_params_schema)
+from simplify import encode_polyline, simplify
+from writebehind import WriteBehind, QueueFull
 
 
 MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/test')
+MONGODB_CLIENT_OPTIONS = {
+    'maxPoolSize': 'MONGODB_MAX_POOL_SIZE',
+    'waitQueueTimeoutMS': 'MONGODB_WAIT_QUEUE_TIMEOUT_MS',
+    'serverSelectionTimeoutMS': 'MONGODB_SERVER_SELECTION_TIMEOUT_MS',
+    'connectTimeoutMS': 'MONGODB_CONNECT_TIMEOUT_MS',
+    'socketTimeoutMS': 'MONGODB_SOCKET_TIMEOUT_MS',
+}
+DEFAULT_PAGE_SIZE = 1000
 
 db = MongoEngine()
-app = Flask(__name__)
-app.config['MONGODB_SETTINGS'] = {
-    'db': MONGODB_URI.split('/')[-1],
-    'host': MONGODB_URI
-}
-db.init_app(app)
+api = Blueprint('api', __name__)
+
+
+def _store(points):
+    """Ingests points, or buffers them if write-behind is enabled.
 
+    Returns accepted documents, errors and the response status code.
+    """
+    if not current_app.config['WRITE_BEHIND']:
+        saved, errors = ingest(points)
+        return saved, errors, 200
 
-@app.route('/')
+    docs, errors = validate_points(points)
+    for doc in docs:
+        doc.id = ObjectId()
+    if not current_app.extensions['write_behind'].put(docs):
+        raise QueueFull()
+    return docs, errors, 202
+
+
+@api.app_errorhandler(QueueFull)
+def queue_full(ex):
+    res = error_response('ingest queue is full, please retry later', 503)
+    res.headers['Retry-After'] = '1'
+    return res
+
+
+@api.route('/')
 @api_response()
 def index():
     return {'app': 'kolejka'}
 
 
-@app.route('/v1/tracking', methods=['POST'])
+@api.route('/metrics')
+def get_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@api.route('/v1/tracking', methods=['POST'])
 @api_response(schema=tracking_schema)
 def tracking(data):
-    obj = Tracking(**data).save()
-    return obj.as_dict()
+    saved, errors, status_code = _store([data])
+    if errors and errors[0].get('duplicate'):
+        points = QuerySet(Tracking, collection_for(data['tracking_timestamp']))
+        point = points.get(
+            **dict((field, data[field]) for field in Tracking.natural_key))
+        return Envelope(point.as_dict(), duplicate=True)
+    if errors:
+        raise SchemaError(errors[0]['error'])
+    return Envelope(saved[0].as_dict(), status_code=status_code)
 
 
-@app.route('/v1/bulk_tracking', methods=['POST'])
+@api.route('/v1/bulk_tracking', methods=['POST'])
 @api_response(schema=bulk_tracking_schema)
 def bulk_tracking(bulk_data):
-    res = []
-    for tracking_data in bulk_data['data']:
-        obj = Tracking(**tracking_data).save()
-        res.append(obj.as_dict())
-    return res
+    points, errors = bulk_data['data']
+    invalid = set(error['index'] for error in errors)
+    indexes = [
+        i for i in range(len(points) + len(errors)) if i not in invalid]
 
+    saved, store_errors, status_code = _store(points)
+    errors.extend(
+        dict(error, index=indexes[error['index']]) for error in store_errors)
+    errors.sort(key=lambda error: error['index'])
 
-@app.route('/v1/zones', methods=['GET'])
+    if request.args.get('response') == 'ids':
+        res = {
+            'inserted_ids': [str(obj.id) for obj in saved],
+            'count': len(saved)
+        }
+    else:
+        res = [obj.as_dict() for obj in saved]
+
+    extra = {}
+    duplicates = [error['index'] for error in errors if error.get('duplicate')]
+    if duplicates:
+        extra['duplicates'] = duplicates
+        errors = [error for error in errors if not error.get('duplicate')]
+    if errors:
+        extra['errors'] = errors
+    return Envelope(res, status_code=status_code, **extra)
+
+
+@api.route('/v1/zones', methods=['GET'])
 @api_response()
 def get_zones():
-    if request.args.get('show_inactive'):
+    show_inactive = bool(request.args.get('show_inactive'))
+    body, etag = zone_cache.memo(
+        ('zones', show_inactive), lambda: _encode_zones(show_inactive))
+    res = current_app.response_class(body, mimetype='application/json')
+    res.set_etag(etag)
+    return res.make_conditional(request)
+
+
+def _encode_zones(show_inactive):
+    """Returns the zone list response body and its strong ETag.
+
+    Zones are read from the primary, like the collection version the body
+    is cached under, so a lagging secondary can't pin a stale list.
+    """
+    if show_inactive:
         zones = Zone.objects.all()
     else:
         zones = Zone.objects.filter(enabled=True)
-    return [zone.as_dict() for zone in zones.order_by('created_at')]
+    body = dumps({
+        'status': 'success',
+        'data': [zone.as_dict() for zone in zones.order_by('created_at')]
+    }, compact=current_app.config.get('JSON_COMPACT', True))
+    return body, hashlib.sha1(body).hexdigest()
+
+
+@api.route('/v1/zones/near', methods=['GET'])
+@api_response(params_schema=zones_near_params_schema)
+def get_zones_near(params):
+    max_distance = params.get('max_distance', 0)
+    zones = Zone.objects(enabled=True, __raw__={'location': {'$nearSphere': {
+        '$geometry': {
+            'type': 'Point',
+            'coordinates': [params['lon'], params['lat']]
+        },
+        '$maxDistance': max_distance + zone_cache.max_radius
+    }}})
+
+    res = []
+    for zone in zones:
+        zone_distance = distance(
+            params['lat'], params['lon'], zone.lat, zone.lon)
+        if zone_distance - zone.radius <= max_distance:
+            res.append(dict(
+                zone.as_dict(), distance=zone_distance,
+                inside=zone_distance <= zone.radius))
+    return res
 
 
-@app.route('/v1/zones', methods=['POST'])
+@api.route('/v1/zones', methods=['POST'])
 @api_response(schema=zone_schema)
 def post_zone(data):
     zone = Zone(**data).save()
     return zone.as_dict()
 
 
-@app.route('/v1/zones/<id>', methods=['DELETE'])
+@api.route('/v1/zones/<id>', methods=['DELETE'])
 @api_response()
 def delete_zone(id):
     zone = Zone.objects.get(pk=id)
@@ -65,27 +204,357 @@ def delete_zone(id):
     zone.save()
 
 
-@app.route('/v1/tracking-data/<tracking_id>', methods=['GET'])
+@api.route('/v1/zones/<id>/stats', methods=['GET'])
 @api_response()
-def get_tracking_data(tracking_id):
-    data = Tracking.objects.all()
-    if tracking_id != 'ALL':
-        data = data.filter(tracking_id=tracking_id)
+def get_zone_stats(id):
+    try:
+        zone_id = ObjectId(id)
+    except InvalidId:
+        raise SchemaError('zone id is invalid')
+
+    stats = ZoneStats.objects(zone_id=zone_id).first()
+    return (stats or ZoneStats(zone_id=zone_id)).as_dict()
+
+
+@api.route('/v1/stats/timeseries', methods=['GET'])
+@api_response(params_schema=timeseries_params_schema)
+def get_timeseries(params):
+    granularity = params.get('granularity', Granularities.hour)
+    data = Rollup.objects(granularity=granularity)
+
+    if 'zone_id' in params:
+        data = data.filter(zone_id=params['zone_id'])
+
+    if params.get('data_type'):
+        data = data.filter(data_type=params['data_type'])
 
-    if request.args.get('data_type'):
-        data = data.filter(data_type=request.args.get('data_type'))
+    # Buckets overlapping the inclusive from/to range are returned.
+    if 'from' in params:
+        data = data.filter(
+            bucket__gte=bucket_start(params['from'], granularity))
 
-    return [point.as_dict() for point in data.order_by('tracking_timestamp')]
+    if 'to' in params:
+        data = data.filter(bucket__lte=params['to'])
 
+    return [rollup.as_dict() for rollup in data.order_by('bucket')]
 
-@app.route('/v1/tracking-data/<tracking_id>', methods=['DELETE'])
+
+@api.route('/v1/positions', methods=['GET'])
+@api_response(params_schema=positions_params_schema)
+def get_positions(params):
+    positions = LastPosition.objects.all()
+    if 'zone_id' in params:
+        positions = positions.filter(zone_id=params['zone_id'])
+    if 'max_age' in params:
+        positions = positions.filter(tracking_timestamp__gte=int(
+            (time.time() - params['max_age']) * 1000))
+    positions = positions.read_preference(
+        current_app.config['READ_PREFERENCE'])
+    return [position.as_dict() for position in positions.order_by('pk')]
+
+
+@api.route('/v1/tracking-feed', methods=['GET'])
+@api_response(params_schema=tracking_feed_params_schema)
+def tracking_feed(params):
+    query = {}
+    if params.get('tracking_id'):
+        query['tracking_id'] = params['tracking_id']
+
+    if 'zone_id' in params:
+        query['zone_id'] = params['zone_id']
+
+    # Browsers send the header on reconnects only, so the first request of
+    # a client resuming from a known event passes it as a parameter.
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        try:
+            last_event_id = ObjectId(last_event_id)
+        except InvalidId:
+            raise SchemaError('Last-Event-ID is invalid')
+    else:
+        last_event_id = params.get('last_event_id')
+
+    return Response(
+        stream_with_context(events(query, last_event_id)),
+        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@api.route('/v1/tracking-feed/last-event-id', methods=['GET'])
+@api_response()
+def get_last_event_id():
+    """Returns the id a feed opened later should resume after."""
+    return {'last_event_id': str(newest_event_id() or ObjectId('0' * 24))}
+
+
+@api.route('/v1/ingest/stats', methods=['GET'])
 @api_response()
-def delete_tracking_data(tracking_id):
-    data = Tracking.objects.all()
+def get_ingest_stats():
+    return current_app.extensions['write_behind'].stats()
+
+
+@api.route('/v1/db/pool', methods=['GET'])
+@api_response()
+def get_db_pool():
+    return pool_stats(get_connection())
+
+
+@api.route('/v1/tracking-data/<tracking_id>', methods=['GET'])
+@api_response(params_schema=tracking_data_params_schema)
+def get_tracking_data(tracking_id, params):
+    path = params.get('format') == 'polyline' or (
+        'tolerance' in params or 'max_points' in params)
+    if path:
+        _check_path_params(tracking_id, params)
+
+    data = _filter_tracking_data(tracking_id, params)
+
+    if 'cursor' in params:
+        timestamp, id = params['cursor']
+        data = data.filter(
+            Q(tracking_timestamp__gt=timestamp) |
+            Q(tracking_timestamp=timestamp, id__gt=id))
+
+    paginate = params.get('format') in (None, 'json') and (
+        'cursor' in params or 'page_size' in params)
+    limit = params.get('page_size', params.get('limit'))
+    if paginate and limit is None:
+        limit = DEFAULT_PAGE_SIZE
+
+    data = data.order_by('tracking_timestamp', 'id').limit(limit)
+    data = data.read_preference(current_app.config['READ_PREFERENCE'])
+    data = data.only(*Tracking.serialized_fields).as_pymongo()
+
+    if params.get('explain'):
+        return _explain(data)
+
+    if path:
+        rows = simplify(
+            list(data.no_cache().batch_size(DEFAULT_PAGE_SIZE)),
+            params.get('tolerance'), params.get('max_points'))
+        if params.get('format') == 'polyline':
+            return {'polyline': encode_polyline(rows), 'count': len(rows)}
+        return serialize_points(rows)
+
+    if params.get('format') == 'ndjson':
+        return _ndjson_response(data)
+
+    if params.get('format') == 'columnar':
+        return Response(
+            encode_points(data.no_cache().batch_size(DEFAULT_PAGE_SIZE)),
+            mimetype='application/octet-stream')
+
+    if not paginate:
+        return serialize_points(
+            data.no_cache().batch_size(DEFAULT_PAGE_SIZE))
+
+    points = list(serialize_points(data))
+    next_cursor = encode_cursor(points[-1]) if len(points) == limit else None
+    return Envelope(points, next_cursor=next_cursor)
+
+
+def _check_path_params(tracking_id, params):
+    if tracking_id == 'ALL':
+        raise SchemaError(
+            'tolerance, max_points and polyline format need a tracking_id')
+    if params.get('format', 'json') not in ('json', 'polyline'):
+        raise SchemaError(
+            'tolerance and max_points support json and polyline formats')
+    if 'cursor' in params or 'page_size' in params:
+        raise SchemaError(
+            'tolerance and max_points can not be used with pagination')
+
+
+def _explain(data):
+    stages, indexes = [], []
+    plan = data.explain()['queryPlanner']['winningPlan']
+    plans = [plan]
+    while plans:
+        plan = plans.pop(0)
+        stages.append(plan['stage'])
+        if 'indexName' in plan:
+            indexes.append(plan['indexName'])
+        if 'inputStage' in plan:
+            plans.append(plan['inputStage'])
+        plans.extend(plan.get('inputStages', []))
+    return {'stages': stages, 'indexes': indexes}
+
+
+def _ndjson_response(data):
+    def generate():
+        rows = data.no_cache().batch_size(DEFAULT_PAGE_SIZE)
+        for point in serialize_points(rows):
+            yield dumps(point) + '\n'
+
+    return Response(
+        stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@api.route('/v1/tracking-data/<tracking_id>', methods=['DELETE'])
+@api_response(params_schema=tracking_data_delete_params_schema)
+def delete_tracking_data(tracking_id, params):
+    if tracking_id == 'ALL' and not params:
+        wipe()
+        return
+
+    dropped = 0
+    if tracking_id == 'ALL' and not (
+            params.get('data_type') or 'zone_id' in params):
+        dropped = drop_partitions(params.get('from'), params.get('to'))
+
+    data = _filter_tracking_data(tracking_id, params)
+    if params.get('background'):
+        purge_in_background(data)
+        return Envelope(None, status_code=202)
+    return {'deleted': dropped + purge(data)}
+
+
+def _filter_tracking_data(tracking_id, params):
+    start = params.get('from')
+    if 'cursor' in params and (start is None or params['cursor'][0] > start):
+        start = params['cursor'][0]
+    data = tracking_points(start, params.get('to'))
     if tracking_id != 'ALL':
         data = data.filter(tracking_id=tracking_id)
 
-    data.delete()
+    if params.get('data_type'):
+        data = data.filter(data_type=params['data_type'])
+
+    if 'zone_id' in params:
+        data = data.filter(zone_id=params['zone_id'])
+
+    if 'from' in params:
+        data = data.filter(tracking_timestamp__gte=params['from'])
+
+    if 'to' in params:
+        data = data.filter(tracking_timestamp__lte=params['to'])
+
+    return data
+
+
+@click.command('backfill-zone-locations')
+@with_appcontext
+def backfill_zone_locations():
+    """Sets GeoJSON location of zones created before it was stored."""
+    zones = list(Zone.objects(location__exists=False))
+    for zone in zones:
+        zone.save()
+    click.echo('Backfilled {} zones'.format(len(zones)))
+
+
+@click.command('rebuild-zone-stats')
+@with_appcontext
+def rebuild_zone_stats():
+    """Recomputes zone occupancy counters from tracking history."""
+    rebuild_occupancy()
+    click.echo('Rebuilt stats of {} zones'.format(ZoneStats.objects.count()))
+
+
+@click.command('remove-duplicate-tracking')
+@with_appcontext
+def remove_duplicate_tracking():
+    """Deletes duplicate tracking points before the unique index is built."""
+    click.echo('Removed {} duplicate points'.format(remove_duplicates()))
+
+
+@click.command('rebuild-positions')
+@with_appcontext
+def rebuild_positions_command():
+    """Recomputes the last position of every device from tracking history."""
+    rebuild_positions()
+    click.echo('Rebuilt positions of {} devices'.format(
+        LastPosition.objects.count()))
+
+
+@click.command('move-to-partitions')
+@with_appcontext
+def move_to_partitions_command():
+    """Moves unpartitioned tracking points into monthly partitions."""
+    click.echo('Moved {} points'.format(move_to_partitions()))
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Recomputes time-bucketed rollups from tracking history."""
+    rebuild_rollups()
+    click.echo('Rebuilt {} rollups'.format(Rollup.objects.count()))
+
+
+@click.command('ensure-indexes')
+@with_appcontext
+def ensure_indexes_command():
+    """Creates the indexes of all collections, run once per deploy."""
+    ensure_indexes()
+    ensure_partition_indexes()
+    click.echo('Indexes are up to date')
+
+
+COMMANDS = (
+    backfill_zone_locations,
+    rebuild_zone_stats,
+    remove_duplicate_tracking,
+    rebuild_positions_command,
+    move_to_partitions_command,
+    rebuild_rollups_command,
+    ensure_indexes_command,
+)
+
+
+def create_app(config=None):
+    """Builds the app; Mongo connects on first use, so also after fork."""
+    app = Flask(__name__)
+    app.config['MONGODB_SETTINGS'] = {
+        'db': MONGODB_URI.split('/')[-1],
+        'host': MONGODB_URI,
+        'connect': False
+    }
+    app.config['MONGODB_SETTINGS'].update(
+        (option, int(os.environ[name]))
+        for option, name in MONGODB_CLIENT_OPTIONS.items()
+        if name in os.environ)
+    app.config['READ_PREFERENCE'] = read_preference(
+        os.environ.get('MONGODB_READ_PREFERENCE', 'primary'),
+        int(os.environ.get('MONGODB_MAX_STALENESS_SECONDS', -1)))
+    app.config['TRACKING_WRITE_CONCERN'] = os.environ.get(
+        'TRACKING_WRITE_CONCERN')
+    app.config['TRACKING_WRITE_JOURNAL'] = (
+        os.environ.get('TRACKING_WRITE_JOURNAL') == '1')
+    app.config['PROFILE_SAMPLE_RATE'] = float(
+        os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_SLOW_MS'] = int(
+        os.environ.get('PROFILE_SLOW_MS', 500))
+    app.config['PROFILE_DIR'] = os.environ.get(
+        'PROFILE_DIR', tempfile.gettempdir())
+    app.config['GEOFENCE_EVENTS'] = os.environ.get('GEOFENCE_EVENTS') == '1'
+    app.config['WRITE_BEHIND'] = os.environ.get('WRITE_BEHIND') == '1'
+    app.config['LIVE_FEED'] = os.environ.get('LIVE_FEED', '1') == '1'
+    app.config.update(config or {})
+    db.init_app(app)
+
+    def write_buffered(docs):
+        with app.app_context():
+            ingest_documents(docs)
+
+    write_behind = WriteBehind(
+        write_buffered,
+        max_size=int(os.environ.get('WRITE_BEHIND_MAX_SIZE', 50000)),
+        batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500)),
+        interval=int(
+            os.environ.get('WRITE_BEHIND_INTERVAL_MS', 200)) / 1000.0,
+        max_retries=int(os.environ.get('WRITE_BEHIND_MAX_RETRIES', 5)))
+    atexit.register(write_behind.close)
+    app.extensions['write_behind'] = write_behind
+
+    app.register_blueprint(api)
+    app.after_request(finish_failed)
+    app.teardown_request(record_unhandled)
+    for command in COMMANDS:
+        app.cli.add_command(command)
+    return app
+
+
+app = create_app()
+write_behind = app.extensions['write_behind']
 
 
 if __name__ == '__main__':
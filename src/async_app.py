@@ -0,0 +1,24 @@
+"""Entry point serving the app on gevent.
+
+Sockets, pymongo and the write-behind flusher are monkey-patched to run on
+greenlets, so a slow client only holds a greenlet instead of a whole
+worker process. Routes, validation and responses are the ones of `app`.
+
+    python src/async_app.py
+
+or, under gunicorn:
+
+    gunicorn -k gevent --worker-connections 2000 --pythonpath src async_app:app
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os  # noqa
+from gevent.pywsgi import WSGIServer  # noqa
+
+from app import app  # noqa
+
+
+if __name__ == '__main__':
+    server = WSGIServer(('0.0.0.0', int(os.environ.get('PORT', 5000))), app)
+    server.serve_forever()
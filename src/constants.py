@@ -9,6 +9,12 @@ class ZoneTypes(object):
     checkpoint = 'checkpoint'
 
 
+class Granularities(object):
+    minute = 'minute'
+    hour = 'hour'
+    day = 'day'
+
+
 DATA_TYPES = (
     (DataTypes.enter, DataTypes.enter),
     (DataTypes.leave, DataTypes.leave),
@@ -20,3 +26,14 @@ ZONE_TYPES = (
     (ZoneTypes.control, ZoneTypes.control),
     (ZoneTypes.checkpoint, ZoneTypes.checkpoint),
 )
+
+
+GRANULARITIES = (
+    (Granularities.minute, Granularities.minute),
+    (Granularities.hour, Granularities.hour),
+    (Granularities.day, Granularities.day),
+)
+
+
+# Code of the write error Mongo reports on a unique index violation.
+DUPLICATE_KEY = 11000
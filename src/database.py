@@ -0,0 +1,69 @@
+from pymongo.errors import BulkWriteError
+from pymongo.read_preferences import (
+    Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest)
+from pymongo.write_concern import WriteConcern
+
+from constants import DUPLICATE_KEY
+
+UPSERT_RETRIES = 3
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def read_preference(mode, max_staleness=-1):
+    """Builds a read preference; `max_staleness` is in seconds, -1 is off."""
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+
+def write_concern(w, journal=False):
+    """Builds a write concern out of a configured `w` string."""
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=journal or None)
+
+
+def bulk_upsert(collection, requests, retries=UPSERT_RETRIES):
+    """Runs upserts with an unordered bulk write.
+
+    Before MongoDB 4.2, concurrent upserts creating the same document can
+    fail with a duplicate key error; the document exists by then, so the
+    failed requests are simply run again.
+    """
+    while requests:
+        try:
+            collection.bulk_write(requests, ordered=False)
+            return
+        except BulkWriteError as ex:
+            errors = ex.details['writeErrors']
+            if retries <= 0 or any(
+                    error['code'] != DUPLICATE_KEY for error in errors):
+                raise
+            requests = [requests[error['index']] for error in errors]
+            retries -= 1
+
+
+def pool_stats(client):
+    """Returns socket counts of the connection pool of every known server.
+
+    pymongo 3.4 has no public API for pool state, so this reads the
+    pools directly.
+    """
+    stats = []
+    for host, port in sorted(client.nodes):
+        server = client._topology.get_server_by_address((host, port))
+        if server is None:
+            continue
+        pool = server.pool
+        stats.append({
+            'address': '{}:{}'.format(host, port),
+            'idle': len(pool.sockets),
+            'in_use': pool.active_sockets,
+            'max_size': pool.opts.max_pool_size
+        })
+    return stats
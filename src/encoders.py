@@ -0,0 +1,66 @@
+import json
+import os
+from collections import OrderedDict
+from datetime import date
+from uuid import UUID
+
+from bson import ObjectId
+from six import text_type
+from werkzeug.http import http_date
+
+
+def default(o):
+    """Encodes values the way Flask's `jsonify` does, plus `ObjectId`."""
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, date):
+        return http_date(o.timetuple())
+    if isinstance(o, UUID):
+        return str(o)
+    if hasattr(o, '__html__'):
+        return text_type(o.__html__())
+    raise TypeError('{!r} is not JSON serializable'.format(o))
+
+
+def _stdlib_compatible(module):
+    def dumps(obj, compact=True):
+        if compact:
+            return module.dumps(
+                obj, default=default, sort_keys=True, separators=(',', ':'))
+        return module.dumps(obj, default=default, sort_keys=True, indent=2)
+    return dumps
+
+
+def _simplejson():
+    import simplejson
+    return _stdlib_compatible(simplejson)
+
+
+def _json():
+    return _stdlib_compatible(json)
+
+
+# simplejson's C speedups are the fastest encoder with a `default` hook
+# that runs on Python 2.
+ENCODERS = OrderedDict([
+    ('simplejson', _simplejson),
+    ('json', _json),
+])
+
+
+def get_encoder(name=None):
+    """Returns `dumps(obj, compact=True)` of the named encoder.
+
+    Without a name the fastest installed encoder is picked.
+    """
+    if name:
+        return ENCODERS[name]()
+
+    for make_encoder in ENCODERS.values():
+        try:
+            return make_encoder()
+        except ImportError:
+            pass
+
+
+dumps = get_encoder(os.environ.get('JSON_ENCODER'))
@@ -0,0 +1,135 @@
+"""Columnar binary export of tracking points.
+
+A payload is the `MAGIC` bytes, the little-endian uint32 length of a JSON
+header, the header padded to 8 bytes and then one buffer per column, each
+also padded to 8 bytes. The header has the row count and, per column, its
+`name`, `type`, and the `offset` and `length` of its buffer counted from
+the end of the header:
+
+* `int64` and `float64` columns are little-endian arrays,
+* `dictionary` columns are int32 codes into the header's `values` list,
+* `objectid` columns are 12-byte ObjectIds back to back.
+
+Timestamps are milliseconds since the epoch. The buffers map directly onto
+NumPy arrays, e.g. `numpy.frombuffer(payload, '<i8', rows, start + offset)`.
+"""
+import json
+import struct
+from bson import ObjectId
+from calendar import timegm
+
+MAGIC = 'KLJC'
+VERSION = 1
+
+INT64 = 'int64'
+FLOAT64 = 'float64'
+DICTIONARY = 'dictionary'
+OBJECTID = 'objectid'
+
+COLUMNS = (
+    ('id', OBJECTID),
+    ('tracking_id', DICTIONARY),
+    ('data_type', DICTIONARY),
+    ('zone_id', DICTIONARY),
+    ('lat', FLOAT64),
+    ('lon', FLOAT64),
+    ('tracking_timestamp', INT64),
+    ('created_at', INT64),
+)
+
+_FORMATS = {INT64: 'q', FLOAT64: 'd', DICTIONARY: 'i'}
+
+
+def _millis(value):
+    if value is None:
+        return 0
+    return timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+
+
+def _pad(data, fill='\0'):
+    return data + fill * (-len(data) % 8)
+
+
+def _columns(rows):
+    ids, lats, lons, timestamps, created = [], [], [], [], []
+    tracking_ids, data_types, zone_ids = {}, {}, {}
+    tracking_codes, data_type_codes, zone_codes = [], [], []
+
+    for row in rows:
+        ids.append(row['_id'].binary)
+        lats.append(row['lat'])
+        lons.append(row['lon'])
+        timestamps.append(row['tracking_timestamp'])
+        created.append(_millis(row.get('created_at')))
+        tracking_codes.append(tracking_ids.setdefault(
+            row['tracking_id'], len(tracking_ids)))
+        data_type_codes.append(data_types.setdefault(
+            row['data_type'], len(data_types)))
+        zone_codes.append(zone_ids.setdefault(
+            str(row['zone_id']), len(zone_ids)))
+
+    columns = {
+        'id': ids, 'lat': lats, 'lon': lons,
+        'tracking_timestamp': timestamps, 'created_at': created,
+        'tracking_id': tracking_codes, 'data_type': data_type_codes,
+        'zone_id': zone_codes}
+    dictionaries = {
+        'tracking_id': tracking_ids, 'data_type': data_types,
+        'zone_id': zone_ids}
+    return len(ids), columns, dictionaries
+
+
+def encode_points(rows):
+    """Encodes raw `tracking` rows, as returned by `.as_pymongo()`."""
+    count, columns, dictionaries = _columns(rows)
+
+    header = {'version': VERSION, 'rows': count, 'columns': []}
+    buffers, offset = [], 0
+    for name, type in COLUMNS:
+        values = columns[name]
+        if type == OBJECTID:
+            buf = ''.join(values)
+        else:
+            buf = struct.pack('<{}{}'.format(len(values), _FORMATS[type]),
+                              *values)
+        buf = _pad(buf)
+
+        column = {'name': name, 'type': type,
+                  'offset': offset, 'length': len(buf)}
+        if type == DICTIONARY:
+            dictionary = dictionaries[name]
+            column['values'] = sorted(dictionary, key=dictionary.get)
+        header['columns'].append(column)
+        buffers.append(buf)
+        offset += len(buf)
+
+    header = _pad(json.dumps(header, separators=(',', ':')), ' ')
+    return ''.join(
+        [MAGIC, struct.pack('<I', len(header)), header] + buffers)
+
+
+def decode_points(payload):
+    """Returns the header and the columns of a payload as lists.
+
+    Ids and dictionary columns are decoded to strings.
+    """
+    if payload[:4] != MAGIC:
+        raise ValueError('not a columnar tracking payload')
+    header_length, = struct.unpack_from('<I', payload, 4)
+    start = 8 + header_length
+    header = json.loads(payload[8:start])
+    count = header['rows']
+
+    columns = {}
+    for column in header['columns']:
+        offset = start + column['offset']
+        if column['type'] == OBJECTID:
+            values = [str(ObjectId(payload[i:i + 12]))
+                      for i in range(offset, offset + count * 12, 12)]
+        else:
+            values = list(struct.unpack_from('<{}{}'.format(
+                count, _FORMATS[column['type']]), payload, offset))
+        if column['type'] == DICTIONARY:
+            values = [column['values'][code] for code in values]
+        columns[column['name']] = values
+    return header, columns
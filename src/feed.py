@@ -0,0 +1,57 @@
+import time
+
+from pymongo import CursorType
+
+from encoders import dumps
+from models import FeedEvent
+
+RECONNECT_DELAY = 1
+
+
+def publish(points):
+    """Appends ingested points to the live feed."""
+    if points:
+        FeedEvent._get_collection().insert_many([{
+            'tracking_id': point.tracking_id,
+            'zone_id': point.zone_id,
+            'point': point.as_dict()
+        } for point in points], ordered=False)
+
+
+def newest_event_id():
+    """Returns the id of the last event in the feed, None if it is empty."""
+    newest = FeedEvent._get_collection().find_one(sort=[('$natural', -1)])
+    return newest['_id'] if newest else None
+
+
+def events(query, last_event_id=None):
+    """Yields Server-Sent Events for points published from now on.
+
+    Follows the capped feed collection with a tailable cursor; `query`
+    narrows the points down and `last_event_id` resumes an interrupted
+    stream. Ids are made by the publishing processes, so they are not in
+    the order events were stored in; a stream is resumed from the position
+    of the last event instead, by reading the feed up to it, or from the
+    start if it has been overwritten since. A comment line is sent whenever
+    the cursor waits in vain, so dead connections are noticed.
+    """
+    collection = FeedEvent._get_collection()
+    if last_event_id is None:
+        last_event_id = newest_event_id()
+
+    while True:
+        skipping = last_event_id is not None and collection.find_one(
+            {'_id': last_event_id}, projection=['_id']) is not None
+        find = {'$or': [query, {'_id': last_event_id}]} if skipping else query
+        cursor = collection.find(find, cursor_type=CursorType.TAILABLE_AWAIT)
+        while cursor.alive:
+            for event in cursor:
+                if skipping:
+                    skipping = event['_id'] != last_event_id
+                    continue
+                last_event_id = event['_id']
+                yield 'id: {}\ndata: {}\n\n'.format(
+                    last_event_id, dumps(event['point']))
+            yield ': keep-alive\n\n'
+        # Tailable cursors die on empty collections, so retry a bit later.
+        time.sleep(RECONNECT_DELAY)
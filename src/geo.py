@@ -0,0 +1,45 @@
+from collections import defaultdict
+from math import asin, cos, floor, radians, sin, sqrt
+
+EARTH_RADIUS = 6371000.0
+METERS_PER_DEGREE = 111195.0
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Returns great-circle distance between two points in meters."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = (sin((lat2 - lat1) / 2) ** 2 +
+         cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+class ZoneGrid(object):
+    """Spatial hash of zone circles over fixed-size lat/lon cells.
+
+    Every zone is registered in all cells its circle overlaps, so a lookup
+    only checks the zones of a single cell, however many zones there are.
+    """
+
+    def __init__(self, zones, cell_size=0.01):
+        self.cell_size = cell_size
+        self._cells = defaultdict(list)
+        for zone in zones:
+            dlat = zone['radius'] / METERS_PER_DEGREE
+            dlon = dlat / max(cos(radians(zone['lat'])), 0.01)
+            lat_cells = range(self._cell(zone['lat'] - dlat),
+                              self._cell(zone['lat'] + dlat) + 1)
+            lon_cells = range(self._cell(zone['lon'] - dlon),
+                              self._cell(zone['lon'] + dlon) + 1)
+            for i in lat_cells:
+                for j in lon_cells:
+                    self._cells[(i, j)].append(zone)
+
+    def _cell(self, degrees):
+        return int(floor(degrees / self.cell_size))
+
+    def containing(self, lat, lon):
+        """Returns zones whose circle contains the point."""
+        candidates = self._cells.get((self._cell(lat), self._cell(lon)), ())
+        return [
+            zone for zone in candidates
+            if distance(lat, lon, zone['lat'], zone['lon']) <= zone['radius']]
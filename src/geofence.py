@@ -0,0 +1,79 @@
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from constants import DUPLICATE_KEY, DataTypes
+from models import GeofenceState, zone_cache
+
+
+def _save_states(states):
+    """Stores device states, unless a newer one of the device is stored.
+
+    Like positions, the filter only matches older states, and the upsert
+    for a device with a newer stored state collides on `_id` and is
+    ignored, so concurrent batches never move a device back in time.
+    """
+    try:
+        GeofenceState._get_collection().bulk_write([
+            UpdateOne({
+                '_id': state['_id'],
+                'tracking_timestamp': {'$lt': state['tracking_timestamp']}
+            }, {'$set': {
+                'zone_ids': state['zone_ids'],
+                'tracking_timestamp': state['tracking_timestamp']
+            }}, upsert=True)
+            for state in states
+        ], ordered=False)
+    except BulkWriteError as ex:
+        if any(error['code'] != DUPLICATE_KEY
+               for error in ex.details['writeErrors']):
+            raise
+
+
+def derive_events(points):
+    """Returns enter/leave points implied by a batch of saved points.
+
+    Every `track` point is checked against the enabled zones and compared
+    with the zones its device was inside of before. Points older than the
+    device's last known position are ignored.
+    """
+    tracks = sorted(
+        (p for p in points if p.data_type == DataTypes.track),
+        key=lambda p: p.tracking_timestamp)
+    if not tracks:
+        return []
+
+    states = {
+        state['_id']: state for state in GeofenceState.objects(
+            tracking_id__in=set(p.tracking_id for p in tracks)).as_pymongo()}
+    grid = zone_cache.grid
+
+    events, changed = [], set()
+    for point in tracks:
+        state = states.get(point.tracking_id)
+        if state and state['tracking_timestamp'] > point.tracking_timestamp:
+            continue
+
+        previous = set(state['zone_ids']) if state else set()
+        current = set(z['_id'] for z in grid.containing(point.lat, point.lon))
+        for data_type, zone_ids in ((DataTypes.leave, previous - current),
+                                    (DataTypes.enter, current - previous)):
+            for zone_id in sorted(zone_ids):
+                events.append({
+                    'tracking_id': point.tracking_id,
+                    'data_type': data_type,
+                    'zone_id': zone_id,
+                    'lat': point.lat,
+                    'lon': point.lon,
+                    'tracking_timestamp': point.tracking_timestamp
+                })
+
+        states[point.tracking_id] = {
+            '_id': point.tracking_id,
+            'zone_ids': sorted(current),
+            'tracking_timestamp': point.tracking_timestamp
+        }
+        changed.add(point.tracking_id)
+
+    if changed:
+        _save_states([states[tracking_id] for tracking_id in changed])
+    return events
@@ -1,8 +1,23 @@
-from flask import jsonify, request
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Response, current_app, request, stream_with_context
 from functools import wraps
 from schema import SchemaError
+from types import GeneratorType
 from werkzeug.exceptions import BadRequest
 
+from encoders import dumps
+from metrics import RequestTimer
+
+
+class Envelope(object):
+    """Response data with extra top-level keys next to `data`."""
+
+    def __init__(self, data, status_code=200, **extra):
+        self.data = data
+        self.status_code = status_code
+        self.extra = extra
+
 
 def _error(msg):
     return {
@@ -11,32 +26,104 @@ def _error(msg):
     }
 
 
-def api_response(schema=None):
+def _json_response(payload, status=200):
+    compact = current_app.config.get('JSON_COMPACT', True)
+    return current_app.response_class(
+        dumps(payload, compact=compact), status=status,
+        mimetype='application/json')
+
+
+def error_response(msg, status=400):
+    return _json_response(_error(msg), status)
+
+
+def _stream_response(items):
+    """Encodes a list payload item by item while it is being sent."""
+    def generate():
+        yield '{"data":['
+        for i, item in enumerate(items):
+            if i:
+                yield ','
+            yield dumps(item)
+        yield '],"status":"success"}'
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype='application/json')
+
+
+def encode_cursor(point):
+    """Returns an opaque pagination cursor pointing right after `point`."""
+    return '{}_{}'.format(point['tracking_timestamp'], point['id'])
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id = cursor.split('_')
+        return int(timestamp), ObjectId(id)
+    except (ValueError, InvalidId):
+        raise SchemaError('cursor is invalid')
+
+
+def _respond(res):
+    if isinstance(res, Response):
+        return res
+    if isinstance(res, GeneratorType):
+        return _stream_response(res)
+    if isinstance(res, Envelope):
+        return _json_response(
+            dict(res.extra, status='success', data=res.data),
+            res.status_code)
+    return _json_response({
+        'status': 'success',
+        'data': res
+    })
+
+
+def _handle(f, schema, params_schema, timer, args, kwargs):
+    with timer.phase('validate'):
+        if schema:
+            try:
+                json = request.get_json()
+            except BadRequest:
+                return _json_response(
+                    _error('please provide valid json payload'), 400)
+
+            if json is None:
+                return _json_response(_error(
+                    'content-type header should be application/json'),
+                    400)
+
+        try:
+            if params_schema:
+                kwargs['params'] = params_schema.validate(
+                    request.args.to_dict())
+            if schema:
+                args = (schema.validate(json),) + args
+        except SchemaError as ex:
+            return _json_response(_error(ex.message), 400)
+
+    try:
+        with timer.phase('view'):
+            res = f(*args, **kwargs)
+    except SchemaError as ex:
+        return _json_response(_error(ex.message), 400)
+
+    with timer.phase('encode'):
+        return _respond(res)
+
+
+def api_response(schema=None, params_schema=None):
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            if schema:
-                try:
-                    json = request.get_json()
-                except BadRequest:
-                    return jsonify(
-                        _error('please provide valid json payload')), 400
-
-                if json is None:
-                    return (jsonify(_error(
-                        'content-type header should be application/json')),
-                        400)
-
-                try:
-                    validated = schema.validate(json)
-                    res = f(validated, *args, **kwargs)
-                except SchemaError as ex:
-                    return jsonify(_error(ex.message)), 400
-            else:
-                res = f(*args, **kwargs)
-            return jsonify({
-                'status': 'success',
-                'data': res
-            })
+            timer = RequestTimer()
+            try:
+                res = _handle(f, schema, params_schema, timer, args, kwargs)
+            except Exception:
+                timer.fail()
+                raise
+            finally:
+                timer.stop()
+            return timer.finish(res)
         return wrapper
     return decorator
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+
+from flask import current_app
+from mongoengine import ValidationError
+from pymongo.errors import BulkWriteError
+
+from constants import DUPLICATE_KEY
+from database import write_concern
+from feed import publish
+from geofence import derive_events
+from models import Tracking
+from occupancy import record_occupancy
+from partitions import collection_for, partition_name
+from positions import record_positions
+from rollups import record_rollups
+
+
+DEDUPLICATE_BATCH_SIZE = 1000
+
+
+def _validation_error(ex):
+    return ', '.join(
+        '{}: {}'.format(field, msg)
+        for field, msg in sorted(ex.to_dict().items()))
+
+
+def validate_points(points):
+    """Builds `Tracking` documents out of payload items.
+
+    Returns documents that passed model validation and a list of errors,
+    each referring to a point by its index.
+    """
+    docs, errors = [], []
+    for index, data in enumerate(points):
+        doc = Tracking(**data)
+        try:
+            doc.validate()
+        except ValidationError as ex:
+            errors.append({'index': index, 'error': _validation_error(ex)})
+        else:
+            docs.append(doc)
+    return docs, errors
+
+
+def _with_write_concern(collection):
+    w = current_app.config.get('TRACKING_WRITE_CONCERN')
+    if w:
+        journal = current_app.config.get('TRACKING_WRITE_JOURNAL')
+        collection = collection.with_options(
+            write_concern=write_concern(w, journal))
+    return collection
+
+
+def _write_error(write_error):
+    if write_error['code'] == DUPLICATE_KEY:
+        return {
+            'index': write_error['index'],
+            'error': 'point is already stored',
+            'duplicate': True
+        }
+    return {'index': write_error['index'], 'error': write_error['errmsg']}
+
+
+def insert_documents(docs):
+    """Inserts `Tracking` documents with an unordered write per partition.
+
+    Documents the write fails for are skipped without affecting the rest of
+    the batch. Returns saved documents and a list of errors, each referring
+    to a document by its index. Errors of points that are already stored
+    are flagged as `duplicate`.
+    """
+    if not docs:
+        return [], []
+
+    raw = [doc.to_mongo() for doc in docs]
+    months, partitions = {}, OrderedDict()
+    for i, son in enumerate(raw):
+        month = partition_name(son['tracking_timestamp'])
+        if month not in months:
+            months[month] = collection_for(son['tracking_timestamp'])
+        collection = months[month]
+        partitions.setdefault(collection.name, (collection, []))[1].append(i)
+
+    errors = []
+    for collection, indexes in partitions.values():
+        try:
+            _with_write_concern(collection).insert_many(
+                [raw[i] for i in indexes], ordered=False)
+        except BulkWriteError as ex:
+            errors.extend(
+                dict(_write_error(write_error),
+                     index=indexes[write_error['index']])
+                for write_error in ex.details['writeErrors'])
+    errors.sort(key=lambda error: error['index'])
+
+    failed = set(error['index'] for error in errors)
+    saved = []
+    for i, (doc, son) in enumerate(zip(docs, raw)):
+        if i not in failed:
+            doc.id = son['_id']
+            saved.append(doc)
+    return saved, errors
+
+
+def insert_points(points):
+    """Validates and inserts tracking points with unordered writes.
+
+    Points that fail model validation or the write itself are skipped
+    without affecting the rest of the batch. Returns saved `Tracking`
+    documents and a list of errors, each referring to a point by its index.
+    """
+    docs, errors = validate_points(points)
+    invalid = set(error['index'] for error in errors)
+    indexes = [i for i in range(len(points)) if i not in invalid]
+
+    saved, write_errors = insert_documents(docs)
+    errors.extend(
+        dict(error, index=indexes[error['index']]) for error in write_errors)
+    errors.sort(key=lambda error: error['index'])
+    return saved, errors
+
+
+def _process(saved):
+    stored = saved
+    if current_app.config.get('GEOFENCE_EVENTS'):
+        events, _ = insert_points(derive_events(saved))
+        stored = saved + events
+
+    record_occupancy(stored)
+    record_rollups(stored)
+    record_positions(stored)
+    if current_app.config.get('LIVE_FEED'):
+        publish(stored)
+
+
+def ingest(points):
+    """Stores tracking points along with the events derived from them.
+
+    Returns the same as `insert_points` for the given points; derived
+    events are stored but not returned.
+    """
+    saved, errors = insert_points(points)
+    _process(saved)
+    return saved, errors
+
+
+def ingest_documents(docs):
+    """Same as `ingest`, for documents that already passed validation."""
+    saved, errors = insert_documents(docs)
+    _process(saved)
+    return saved, errors
+
+
+def remove_duplicates():
+    """Deletes all but the first of tracking points sharing a natural key.
+
+    Works on the raw collection, so it runs before the unique index exists.
+    Returns the number of deleted points.
+    """
+    collection = Tracking._get_db()[Tracking._get_collection_name()]
+    groups = collection.aggregate([
+        {'$group': {
+            '_id': dict((field, '$' + field)
+                        for field in Tracking.natural_key),
+            'ids': {'$push': '$_id'},
+            'count': {'$sum': 1}
+        }},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)
+
+    deleted, batch = 0, []
+    for group in groups:
+        batch.extend(sorted(group['ids'])[1:])
+        if len(batch) >= DEDUPLICATE_BATCH_SIZE:
+            deleted += collection.delete_many(
+                {'_id': {'$in': batch}}).deleted_count
+            batch = []
+    if batch:
+        deleted += collection.delete_many(
+            {'_id': {'$in': batch}}).deleted_count
+    return deleted
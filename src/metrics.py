@@ -0,0 +1,208 @@
+"""Request timings, Mongo command counts and per-route latency histograms.
+
+Metrics are kept per process, so every worker reports its own share of
+the traffic at /metrics, labelled with its `pid`; sum series over `pid`
+to see the whole app.
+"""
+import cProfile
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+from pymongo import monitoring
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Commands(threading.local):
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+_commands = _Commands()
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts Mongo commands and their round trips in the calling thread."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        _commands.count += 1
+        _commands.duration += event.duration_micros / 1e6
+
+    failed = succeeded
+
+
+# Listeners only apply to clients created after they are registered.
+monitoring.register(CommandCounter())
+
+
+class Histogram(object):
+    """Prometheus histogram with a series per set of label values."""
+
+    def __init__(self, name, help, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._counts = defaultdict(lambda: [0] * (len(buckets) + 1))
+        self._sums = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            self._counts[labels][bisect_left(self.buckets, value)] += 1
+            self._sums[labels] += value
+
+    def _labels(self, values, **extra):
+        pairs = zip(self.label_names, values) + sorted(extra.items())
+        return ','.join('{}="{}"'.format(k, v) for k, v in pairs)
+
+    def render(self, **const):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted(
+                (labels, list(counts), self._sums[labels])
+                for labels, counts in self._counts.items())
+
+        for labels, counts, total in series:
+            cumulative = 0
+            bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name, self._labels(labels, le=bound, **const),
+                    cumulative))
+            lines.append('{}_sum{{{}}} {!r}'.format(
+                self.name, self._labels(labels, **const), total))
+            lines.append('{}_count{{{}}} {}'.format(
+                self.name, self._labels(labels, **const), cumulative))
+        return lines
+
+
+class Counter(object):
+    """Prometheus counter with a series per set of label values."""
+
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self._lock:
+            self._values[labels] += value
+
+    def render(self, **const):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            series = sorted(self._values.items())
+        for labels, value in series:
+            pairs = zip(self.label_names, labels) + sorted(const.items())
+            lines.append('{}{{{}}} {}'.format(self.name, ','.join(
+                '{}="{}"'.format(k, v) for k, v in pairs), value))
+        return lines
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Latency of API requests.',
+    ('route', 'method', 'status'))
+mongo_commands = Counter(
+    'mongo_commands_total', 'Mongo commands sent by API requests.',
+    ('route', 'method', 'status'))
+
+
+def render():
+    """Returns all metrics in the Prometheus text format."""
+    pid = os.getpid()
+    lines = request_duration.render(pid=pid) + mongo_commands.render(pid=pid)
+    return '\n'.join(lines) + '\n'
+
+
+def finish_failed(response):
+    """Records a request whose view raised, once its error is handled."""
+    timer = g.pop('failed_request', None)
+    if timer is not None:
+        timer.finish(response)
+    return response
+
+
+def record_unhandled(exception):
+    """Records a request whose view raised and got no response at all."""
+    timer = g.pop('failed_request', None)
+    if timer is not None:
+        timer.record(500)
+
+
+class RequestTimer(object):
+    """Times phases of the current request.
+
+    `stop` ends the request, `finish` records it in the metrics and adds
+    a `Server-Timing` header to its response. `fail` defers that to the
+    app's error handling when the view raises. With `PROFILE_SAMPLE_RATE`
+    set, that fraction of requests runs under cProfile, and the profile is
+    dumped to `PROFILE_DIR` if the request took at least `PROFILE_SLOW_MS`.
+    """
+
+    def __init__(self):
+        _commands.count = 0
+        _commands.duration = 0.0
+        self.phases = []
+        self.profiler = None
+        if random.random() < current_app.config['PROFILE_SAMPLE_RATE']:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.started = time.time()
+        self.duration = None
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - started))
+
+    def stop(self):
+        self.duration = duration = time.time() - self.started
+        if self.profiler is None:
+            return
+
+        self.profiler.disable()
+        if duration * 1000 >= current_app.config['PROFILE_SLOW_MS']:
+            self.profiler.dump_stats(os.path.join(
+                current_app.config['PROFILE_DIR'], '{}-{}-{}ms.prof'.format(
+                    int(self.started), request.endpoint,
+                    int(duration * 1000))))
+
+    def fail(self):
+        g.failed_request = self
+
+    def record(self, status):
+        rule = request.url_rule.rule if request.url_rule else 'unknown'
+        labels = (rule, request.method, str(status))
+        request_duration.observe(labels, self.duration)
+        mongo_commands.inc(labels, _commands.count)
+
+    def finish(self, response):
+        duration = self.duration
+        self.record(response.status_code)
+
+        timings = ['{};dur={:.2f}'.format(name, seconds * 1000)
+                   for name, seconds in self.phases]
+        timings.append('db;dur={:.2f};desc="{} commands"'.format(
+            _commands.duration * 1000, _commands.count))
+        timings.append('total;dur={:.2f}'.format(duration * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+        return response
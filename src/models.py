@@ -1,29 +1,62 @@
+import os
+import time
 from mongoengine import (
     Document, ObjectIdField, StringField, FloatField, IntField, DateTimeField,
-    BooleanField)
+    BooleanField, ListField, PointField, DictField)
 from datetime import datetime
 
-from constants import DATA_TYPES, ZONE_TYPES
+from constants import DATA_TYPES, ZONE_TYPES, GRANULARITIES
+from geo import ZoneGrid
 
 
-class Tracking(Document):
+ZONE_CACHE_TTL = float(os.environ.get('ZONE_CACHE_TTL', 1))
+TRACKING_RETENTION_DAYS = int(os.environ.get('TRACKING_RETENTION_DAYS', 0))
+LIVE_FEED_SIZE = int(os.environ.get('LIVE_FEED_SIZE_MB', 16)) * 1024 * 1024
+
+
+class Model(Document):
+    """Document whose indexes are only built by `ensure_indexes`.
+
+    Without it mongoengine checks all indexes of a collection the first
+    time every worker touches it.
+    """
+    meta = {'abstract': True, 'auto_create_index': False}
+
+
+class Tracking(Model):
     tracking_id = StringField(required=True)
     data_type = StringField(max_length=5, choices=DATA_TYPES, required=True)
     zone_id = ObjectIdField(required=True)
     lat = FloatField(required=True)
     lon = FloatField(required=True)
     tracking_timestamp = IntField(required=True)
-    created_at = DateTimeField(default=datetime.now)
+    # UTC, as Mongo reads dates of the TTL index.
+    created_at = DateTimeField(default=datetime.utcnow)
+
+    # Retried posts of the same point are rejected by the unique index.
+    natural_key = ('tracking_id', 'tracking_timestamp', 'data_type', 'zone_id')
 
     meta = {
         'indexes': [
-            ('tracking_id', 'tracking_timestamp')
-        ]
+            {'fields': natural_key, 'unique': True},
+            # Results are ordered by tracking_timestamp and id, so every
+            # index a query can match on also has to sort with both.
+            ('tracking_timestamp', 'id'),
+            ('tracking_id', 'tracking_timestamp', 'id'),
+            ('zone_id', 'tracking_timestamp', 'id'),
+            ('data_type', 'tracking_timestamp', 'id')
+        ] + ([{
+            'fields': ['created_at'],
+            'expireAfterSeconds': TRACKING_RETENTION_DAYS * 24 * 60 * 60
+        }] if TRACKING_RETENTION_DAYS else [])
     }
 
+    serialized_fields = (
+        'id', 'tracking_id', 'data_type', 'zone_id', 'lat', 'lon',
+        'tracking_timestamp', 'created_at')
+
     def as_dict(self):
-        zones_dict = {
-            str(z.id): z.name for z in Zone.objects.filter(enabled=True)}
+        zones_dict = zone_cache.names
 
         return {
             'id': str(self.id),
@@ -40,7 +73,36 @@ class Tracking(Document):
         }
 
 
-class Zone(Document):
+def serialize_points(rows):
+    """Formats raw `tracking` rows exactly like `Tracking.as_dict` does.
+
+    Rows come from `.as_pymongo()` querysets, so no documents are hydrated.
+    Consecutive rows usually share the same second, so `tracking_time` is
+    formatted once per distinct second.
+    """
+    zones_dict = zone_cache.names
+    seconds, tracking_time = None, None
+    for row in rows:
+        zone_id = str(row['zone_id'])
+        if row['tracking_timestamp']/1000 != seconds:
+            seconds = row['tracking_timestamp']/1000
+            tracking_time = str(datetime.fromtimestamp(seconds))
+
+        yield {
+            'id': str(row['_id']),
+            'tracking_id': row['tracking_id'],
+            'data_type': row['data_type'],
+            'zone_id': zone_id,
+            'zone_name': zones_dict.get(zone_id, zone_id),
+            'tracking_timestamp': row['tracking_timestamp'],
+            'tracking_time': tracking_time,
+            'created_at': str(row.get('created_at')),
+            'lon': row['lon'],
+            'lat': row['lat']
+        }
+
+
+class Zone(Model):
     name = StringField(required=True)
     description = StringField()
     zone_type = StringField(choices=ZONE_TYPES, required=True)
@@ -50,8 +112,235 @@ class Zone(Document):
     radius = IntField(required=True)
     enabled = BooleanField(default=True)
     created_at = DateTimeField(default=datetime.now)
+    location = PointField()
+
+    def clean(self):
+        self.location = [self.lon, self.lat]
+
+    def save(self, *args, **kwargs):
+        zone = super(Zone, self).save(*args, **kwargs)
+        zone_cache.invalidate()
+        return zone
 
     def as_dict(self):
         data = self.to_mongo()
         data['id'] = str(data.pop('_id'))
+        data.pop('location', None)
         return data
+
+
+class GeofenceState(Model):
+    """Zones a device was inside of at its last `track` point."""
+    tracking_id = StringField(primary_key=True)
+    zone_ids = ListField(ObjectIdField())
+    tracking_timestamp = IntField(required=True)
+
+
+class Presence(Model):
+    """Device that entered a zone and has not left it yet."""
+    tracking_id = StringField(required=True)
+    zone_id = ObjectIdField(required=True)
+    tracking_timestamp = IntField(required=True)
+
+    meta = {
+        'indexes': [
+            {'fields': ('tracking_id', 'zone_id'), 'unique': True}
+        ]
+    }
+
+
+class ZoneStats(Model):
+    """Occupancy and dwell time of a zone, updated at ingest."""
+    zone_id = ObjectIdField(primary_key=True)
+    occupancy = IntField(default=0)
+    enters = IntField(default=0)
+    leaves = IntField(default=0)
+    dwell_time = IntField(default=0)
+    dwells = IntField(default=0)
+
+    def as_dict(self):
+        return {
+            'zone_id': str(self.zone_id),
+            'occupancy': self.occupancy,
+            'enters': self.enters,
+            'leaves': self.leaves,
+            'average_dwell_time': (
+                self.dwell_time / self.dwells if self.dwells else None)
+        }
+
+
+class LastPosition(Model):
+    """Newest tracking point of a device, updated at ingest."""
+    tracking_id = StringField(primary_key=True)
+    data_type = StringField(choices=DATA_TYPES, required=True)
+    zone_id = ObjectIdField(required=True)
+    lat = FloatField(required=True)
+    lon = FloatField(required=True)
+    tracking_timestamp = IntField(required=True)
+
+    meta = {
+        'indexes': [
+            ('zone_id', 'tracking_timestamp'),
+            'tracking_timestamp'
+        ]
+    }
+
+    def as_dict(self):
+        return {
+            'tracking_id': self.tracking_id,
+            'data_type': self.data_type,
+            'zone_id': str(self.zone_id),
+            'lat': self.lat,
+            'lon': self.lon,
+            'tracking_timestamp': self.tracking_timestamp
+        }
+
+
+class Rollup(Model):
+    """Number of tracking points of a kind per zone and time bucket."""
+    granularity = StringField(choices=GRANULARITIES, required=True)
+    zone_id = ObjectIdField(required=True)
+    data_type = StringField(choices=DATA_TYPES, required=True)
+    bucket = IntField(required=True)
+    count = IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {
+                'fields': ('granularity', 'zone_id', 'data_type', 'bucket'),
+                'unique': True
+            },
+            ('granularity', 'bucket')
+        ]
+    }
+
+    def as_dict(self):
+        return {
+            'granularity': self.granularity,
+            'zone_id': str(self.zone_id),
+            'data_type': self.data_type,
+            'bucket': self.bucket,
+            'count': self.count
+        }
+
+
+class FeedEvent(Model):
+    """Recently ingested point, kept in a capped collection for tailing."""
+    tracking_id = StringField(required=True)
+    zone_id = ObjectIdField(required=True)
+    point = DictField(required=True)
+
+    meta = {
+        'max_size': LIVE_FEED_SIZE
+    }
+
+
+class CollectionVersion(Model):
+    """Change counter for a collection, shared by all workers."""
+    name = StringField(primary_key=True)
+    version = IntField(default=0)
+
+    @classmethod
+    def bump(cls, name):
+        cls.objects(name=name).update_one(inc__version=1, upsert=True)
+
+    @classmethod
+    def current(cls, name):
+        obj = cls.objects(name=name).first()
+        return obj.version if obj else 0
+
+
+class ZoneCache(object):
+    """Per-worker snapshot of enabled zones and values derived from them.
+
+    The snapshot is reloaded when the `zone` collection version changes.
+    The version itself is re-read at most once per `ttl` seconds, so changes
+    made by other workers are picked up within that window.
+    """
+
+    def __init__(self, ttl=ZONE_CACHE_TTL):
+        self.ttl = ttl
+        self._zones = None
+        self._names = None
+        self._grid = None
+        self._max_radius = None
+        self._version = None
+        self._memo = {}
+        self._checked_at = 0
+
+    def invalidate(self):
+        """Marks zones as changed for this worker and all the others."""
+        CollectionVersion.bump('zone')
+        self._zones = None
+
+    def _refresh(self):
+        now = time.time()
+        if self._zones is not None and now - self._checked_at < self.ttl:
+            return
+
+        version = CollectionVersion.current('zone')
+        if self._zones is None or version != self._version:
+            self._zones = list(
+                Zone.objects.filter(enabled=True).only(
+                    'id', 'name', 'lat', 'lon', 'radius').as_pymongo())
+            self._names = {str(z['_id']): z['name'] for z in self._zones}
+            self._max_radius = max([z['radius'] for z in self._zones] or [0])
+            self._grid = None
+            self._memo = {}
+            self._version = version
+        self._checked_at = now
+
+    def memo(self, key, build):
+        """Returns `build()`, computed once per zone collection version."""
+        self._refresh()
+        if key not in self._memo:
+            self._memo[key] = build()
+        return self._memo[key]
+
+    @property
+    def names(self):
+        self._refresh()
+        return self._names
+
+    @property
+    def max_radius(self):
+        self._refresh()
+        return self._max_radius
+
+    @property
+    def grid(self):
+        self._refresh()
+        if self._grid is None:
+            self._grid = ZoneGrid(self._zones)
+        return self._grid
+
+
+zone_cache = ZoneCache()
+
+
+def sync_retention(collection):
+    """Aligns an existing TTL index of tracking points with the retention.
+
+    Mongo refuses to create an index whose options differ from the existing
+    one, so a changed retention is applied with `collMod` and a disabled
+    one drops the index.
+    """
+    seconds = TRACKING_RETENTION_DAYS * 24 * 60 * 60
+    for name, index in collection.index_information().items():
+        if index['key'] != [('created_at', 1)]:
+            continue
+        if not seconds:
+            collection.drop_index(name)
+        elif index.get('expireAfterSeconds') != seconds:
+            collection.database.command('collMod', collection.name, index={
+                'keyPattern': {'created_at': 1},
+                'expireAfterSeconds': seconds
+            })
+
+
+def ensure_indexes():
+    """Creates missing indexes of all collections."""
+    sync_retention(Tracking._get_collection())
+    for model in (Tracking, Zone, GeofenceState, Presence, ZoneStats,
+                  LastPosition, Rollup, FeedEvent, CollectionVersion):
+        model.ensure_indexes()
@@ -0,0 +1,128 @@
+from collections import Counter, defaultdict
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from constants import DUPLICATE_KEY, DataTypes
+from database import bulk_upsert
+from models import Presence, ZoneStats
+from partitions import tracking_points
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def _open_presences(events):
+    """Returns open presences of the devices and zones of a batch."""
+    keys = set((p.tracking_id, p.zone_id) for p in events)
+    presences = Presence._get_collection().find({
+        'tracking_id': {'$in': list(set(key[0] for key in keys))},
+        'zone_id': {'$in': list(set(key[1] for key in keys))}
+    })
+    return dict(
+        ((presence['tracking_id'], presence['zone_id']), presence)
+        for presence in presences
+        if (presence['tracking_id'], presence['zone_id']) in keys)
+
+
+def _close(closes, increments):
+    """Deletes presences read at the start of the batch, one at a time.
+
+    A presence a concurrent batch closed first is gone, so its leave is
+    taken back out of the counters.
+    """
+    collection = Presence._get_collection()
+    for presence, dwell_time in closes:
+        if collection.find_one_and_delete({'_id': presence['_id']}) is None:
+            inc = increments[presence['zone_id']]
+            inc['occupancy'] += 1
+            inc['dwell_time'] -= dwell_time
+            inc['dwells'] -= 1
+
+
+def _open(opens, increments):
+    """Inserts presences opened by the batch with one write.
+
+    A presence a concurrent batch opened first is rejected by the unique
+    index, so its enter is not counted in the occupancy.
+    """
+    if not opens:
+        return
+    try:
+        Presence._get_collection().insert_many(opens, ordered=False)
+    except BulkWriteError as ex:
+        errors = ex.details['writeErrors']
+        if any(error['code'] != DUPLICATE_KEY for error in errors):
+            raise
+        for error in errors:
+            increments[opens[error['index']]['zone_id']]['occupancy'] -= 1
+
+
+def record_occupancy(points):
+    """Applies enter/leave points to per-zone occupancy counters.
+
+    Open presences of the batch are read at once and replayed in memory, so
+    devices entering and leaving within a batch cost no round trips. Stored
+    presences are then closed atomically, new ones inserted in one write
+    and counters of all zones updated with `$inc` in a single bulk write.
+    """
+    events = sorted(
+        (p for p in points
+         if p.data_type in (DataTypes.enter, DataTypes.leave)),
+        key=lambda p: p.tracking_timestamp)
+    if not events:
+        return
+
+    stored = _open_presences(events)
+    presences = dict(stored)
+    increments = defaultdict(Counter)
+    closes = []
+    for point in events:
+        key = (point.tracking_id, point.zone_id)
+        inc = increments[point.zone_id]
+        if point.data_type == DataTypes.enter:
+            inc['enters'] += 1
+            if key not in presences:
+                presences[key] = {
+                    'tracking_id': point.tracking_id,
+                    'zone_id': point.zone_id,
+                    'tracking_timestamp': point.tracking_timestamp
+                }
+                inc['occupancy'] += 1
+        else:
+            inc['leaves'] += 1
+            presence = presences.pop(key, None)
+            if presence is not None:
+                dwell_time = (
+                    point.tracking_timestamp - presence['tracking_timestamp'])
+                inc['occupancy'] -= 1
+                inc['dwell_time'] += dwell_time
+                inc['dwells'] += 1
+                if presence is stored.get(key):
+                    closes.append((presence, dwell_time))
+
+    _close(closes, increments)
+    _open([presence for key, presence in presences.items()
+           if presence is not stored.get(key)], increments)
+
+    bulk_upsert(ZoneStats._get_collection(), [
+        UpdateOne({'_id': zone_id}, {'$inc': dict(inc)}, upsert=True)
+        for zone_id, inc in increments.items()
+    ])
+
+
+def rebuild_occupancy():
+    """Recomputes occupancy counters from the whole enter/leave history."""
+    Presence.drop_collection()
+    ZoneStats.drop_collection()
+    Presence.ensure_indexes()
+
+    events = tracking_points().filter(
+        data_type__in=[DataTypes.enter, DataTypes.leave]).order_by(
+            'tracking_timestamp', 'id').no_cache()
+    batch = []
+    for point in events:
+        batch.append(point)
+        if len(batch) == REBUILD_BATCH_SIZE:
+            record_occupancy(batch)
+            batch = []
+    record_occupancy(batch)
@@ -0,0 +1,213 @@
+"""Monthly partitions of tracking points.
+
+With TRACKING_PARTITIONS=monthly, points are stored in one collection per
+UTC calendar month of their `tracking_timestamp`, e.g. `tracking_2017_02`,
+each with the indexes of `Tracking`. Reads only touch the partitions that
+overlap the requested time range and whole months are deleted by dropping
+their collection, so index builds and purges stay as large as a month of
+data however much history is kept. Otherwise all points stay in the
+`tracking` collection.
+"""
+import os
+import re
+from calendar import timegm
+from collections import defaultdict
+from datetime import datetime
+
+from mongoengine.queryset import QuerySet
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError
+
+from constants import DUPLICATE_KEY
+from models import Tracking, sync_retention
+
+TRACKING_PARTITIONS = os.environ.get('TRACKING_PARTITIONS') == 'monthly'
+MOVE_BATCH_SIZE = 1000
+
+PARTITION_NAME = re.compile(r'^tracking_(\d{4})_(\d{2})$')
+
+
+def partition_name(tracking_timestamp):
+    date = datetime.utcfromtimestamp(tracking_timestamp // 1000)
+    return 'tracking_{:04d}_{:02d}'.format(date.year, date.month)
+
+
+def _time_range(name):
+    """Returns the first and last timestamp a partition can hold."""
+    year, month = map(int, PARTITION_NAME.match(name).groups())
+    first = timegm((year, month, 1, 0, 0, 0)) * 1000
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return first, timegm((year, month, 1, 0, 0, 0)) * 1000 - 1
+
+
+def _create_indexes(collection):
+    for spec in Tracking._meta['index_specs']:
+        spec = dict(spec)
+        collection.create_index(spec.pop('fields'), **spec)
+
+
+def _partition(name):
+    """Returns a partition to write to, indexed if it is a new one.
+
+    The unique natural key index is created on every call, a no-op unless
+    the partition is new or was dropped by another process meanwhile; the
+    other indexes are then created too. Indexes of existing partitions are
+    left to `ensure_partition_indexes`.
+    """
+    db = Tracking._get_db()
+    spec = dict(next(
+        spec for spec in Tracking._meta['index_specs'] if spec.get('unique')))
+    res = db.command('createIndexes', name, indexes=[
+        IndexModel(spec.pop('fields'), **spec).document])
+    if (res.get('createdCollectionAutomatically') or
+            res['numIndexesBefore'] != res['numIndexesAfter']):
+        _create_indexes(db[name])
+    return db[name]
+
+
+def partition_names(start=None, end=None):
+    """Returns existing partitions overlapping a time range, oldest first."""
+    names = []
+    for name in Tracking._get_db().collection_names():
+        if PARTITION_NAME.match(name):
+            first, last = _time_range(name)
+            if ((start is None or last >= start) and
+                    (end is None or first <= end)):
+                names.append(name)
+    return sorted(names)
+
+
+def ensure_partition_indexes():
+    """Creates missing indexes of all existing partitions."""
+    for name in partition_names():
+        collection = Tracking._get_db()[name]
+        sync_retention(collection)
+        _create_indexes(collection)
+
+
+def collections(start=None, end=None):
+    """Returns collections that may hold points of a time range."""
+    if not TRACKING_PARTITIONS:
+        return [Tracking._get_collection()]
+    db = Tracking._get_db()
+    return [db[name] for name in partition_names(start, end)]
+
+
+def collection_for(tracking_timestamp):
+    """Returns the collection a point with the timestamp is stored in."""
+    if not TRACKING_PARTITIONS:
+        return Tracking._get_collection()
+    return _partition(partition_name(tracking_timestamp))
+
+
+def tracking_points(start=None, end=None):
+    """Returns a query over points of the partitions of a time range."""
+    return PartitionedQuery([
+        QuerySet(Tracking, collection)
+        for collection in collections(start, end)])
+
+
+def drop_partitions(start=None, end=None):
+    """Drops partitions lying entirely within a time range.
+
+    Returns the number of dropped points.
+    """
+    if not TRACKING_PARTITIONS:
+        return 0
+
+    dropped = 0
+    for name in partition_names(start, end):
+        first, last = _time_range(name)
+        if (start is None or start <= first) and (end is None or last <= end):
+            collection = Tracking._get_db()[name]
+            dropped += collection.count()
+            collection.drop()
+    return dropped
+
+
+def move_to_partitions(batch_size=MOVE_BATCH_SIZE):
+    """Moves points of the `tracking` collection into their partitions.
+
+    Points are copied before they are deleted, so an interrupted move can
+    be run again. Returns the number of moved points.
+    """
+    source = Tracking._get_db()[Tracking._get_collection_name()]
+    moved = 0
+    while True:
+        batch = list(source.find().limit(batch_size))
+        if not batch:
+            return moved
+
+        partitions = defaultdict(list)
+        for son in batch:
+            partitions[partition_name(son['tracking_timestamp'])].append(son)
+        for name, sons in partitions.items():
+            try:
+                _partition(name).insert_many(sons, ordered=False)
+            except BulkWriteError as ex:
+                if any(error['code'] != DUPLICATE_KEY
+                       for error in ex.details['writeErrors']):
+                    raise
+
+        source.delete_many({'_id': {'$in': [son['_id'] for son in batch]}})
+        moved += len(batch)
+
+
+class PartitionedQuery(object):
+    """Querysets of consecutive partitions read as a single queryset.
+
+    Partitions hold disjoint and increasing time ranges, so results ordered
+    by `tracking_timestamp` are read partition by partition, and the limit
+    is what is left of it after the previous partitions.
+    """
+
+    def __init__(self, querysets, limit=None):
+        self.querysets = querysets
+        self._limit = limit
+
+    def _map(self, method, *args, **kwargs):
+        return PartitionedQuery([
+            getattr(queryset, method)(*args, **kwargs)
+            for queryset in self.querysets], self._limit)
+
+    def filter(self, *args, **kwargs):
+        return self._map('filter', *args, **kwargs)
+
+    def order_by(self, *keys):
+        return self._map('order_by', *keys)
+
+    def only(self, *fields):
+        return self._map('only', *fields)
+
+    def as_pymongo(self):
+        return self._map('as_pymongo')
+
+    def read_preference(self, read_preference):
+        return self._map('read_preference', read_preference)
+
+    def no_cache(self):
+        return self._map('no_cache')
+
+    def batch_size(self, size):
+        return self._map('batch_size', size)
+
+    def limit(self, n):
+        return PartitionedQuery(self.querysets, n)
+
+    def explain(self):
+        """Explains the query of the first partition that is read."""
+        if not self.querysets:
+            return {'queryPlanner': {'winningPlan': {'stage': 'EOF'}}}
+        return self.querysets[0].limit(self._limit).explain()
+
+    def __iter__(self):
+        remaining = self._limit
+        for queryset in self.querysets:
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                queryset = queryset.limit(remaining)
+            for row in queryset:
+                yield row
+                if remaining is not None:
+                    remaining -= 1
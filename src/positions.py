@@ -0,0 +1,71 @@
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from constants import DUPLICATE_KEY
+from models import LastPosition
+from partitions import collections
+
+POSITION_FIELDS = ('data_type', 'zone_id', 'lat', 'lon', 'tracking_timestamp')
+REBUILD_BATCH_SIZE = 1000
+
+
+def _move(positions):
+    """Stores positions, unless a newer one of the device is stored.
+
+    The filter only matches positions older than the given one; for a newer
+    stored one the upsert collides on `_id` instead, which is ignored.
+    """
+    try:
+        LastPosition._get_collection().bulk_write([
+            UpdateOne({
+                '_id': position['_id'],
+                'tracking_timestamp': {
+                    '$lt': position['tracking_timestamp']}
+            }, {'$set': dict(
+                (field, position[field]) for field in POSITION_FIELDS)},
+                upsert=True)
+            for position in positions
+        ], ordered=False)
+    except BulkWriteError as ex:
+        if any(error['code'] != DUPLICATE_KEY
+               for error in ex.details['writeErrors']):
+            raise
+
+
+def record_positions(points):
+    """Moves devices to their newest point in the batch, if it is newer."""
+    latest = {}
+    for point in points:
+        current = latest.get(point.tracking_id)
+        if (current is None or
+                point.tracking_timestamp > current.tracking_timestamp):
+            latest[point.tracking_id] = point
+    if latest:
+        _move([dict(
+            [('_id', tracking_id)] +
+            [(field, getattr(point, field)) for field in POSITION_FIELDS])
+            for tracking_id, point in latest.items()])
+
+
+def rebuild_positions():
+    """Recomputes positions of all devices from raw history."""
+    LastPosition.drop_collection()
+    LastPosition.ensure_indexes()
+
+    for collection in collections():
+        rows = collection.aggregate([
+            {'$sort': {'tracking_id': -1, 'tracking_timestamp': -1}},
+            {'$group': dict(
+                [('_id', '$tracking_id')] +
+                [(field, {'$first': '$' + field})
+                 for field in POSITION_FIELDS])}
+        ], allowDiskUse=True)
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == REBUILD_BATCH_SIZE:
+                _move(batch)
+                batch = []
+        if batch:
+            _move(batch)
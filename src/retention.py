@@ -0,0 +1,46 @@
+import logging
+import threading
+
+from models import Tracking
+from partitions import drop_partitions
+
+PURGE_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def purge(queryset, batch_size=PURGE_BATCH_SIZE):
+    """Deletes matching points in batches of `batch_size`.
+
+    Every batch is a short delete by `_id`, so other writes to the
+    collection are not held up for the whole purge. Takes a queryset or a
+    partitioned query, returns the number of deleted points.
+    """
+    deleted = 0
+    for queryset in getattr(queryset, 'querysets', [queryset]):
+        while True:
+            ids = list(queryset.limit(batch_size).scalar('id'))
+            if not ids:
+                break
+            deleted += queryset._collection.delete_many(
+                {'_id': {'$in': ids}}).deleted_count
+    return deleted
+
+
+def purge_in_background(queryset):
+    def run():
+        try:
+            logger.info('Purged %d tracking points', purge(queryset))
+        except Exception:
+            logger.exception('Failed to purge tracking points')
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
+def wipe():
+    """Deletes all points by dropping and recreating the collection."""
+    drop_partitions()
+    Tracking.drop_collection()
+    Tracking.ensure_indexes()
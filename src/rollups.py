@@ -0,0 +1,81 @@
+from collections import Counter
+
+from pymongo import UpdateOne
+
+from constants import Granularities
+from database import bulk_upsert
+from models import Rollup
+from partitions import collections
+
+BUCKET_SIZES = {
+    Granularities.minute: 60 * 1000,
+    Granularities.hour: 60 * 60 * 1000,
+    Granularities.day: 24 * 60 * 60 * 1000,
+}
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def bucket_start(tracking_timestamp, granularity):
+    return tracking_timestamp - tracking_timestamp % BUCKET_SIZES[granularity]
+
+
+def _upsert(key, update):
+    granularity, zone_id, data_type, bucket = key
+    return UpdateOne({
+        'granularity': granularity,
+        'zone_id': zone_id,
+        'data_type': data_type,
+        'bucket': bucket
+    }, update, upsert=True)
+
+
+def record_rollups(points):
+    """Counts points into every granularity's buckets with `$inc` upserts."""
+    counts = Counter(
+        (granularity, p.zone_id, p.data_type,
+         bucket_start(p.tracking_timestamp, granularity))
+        for p in points for granularity in BUCKET_SIZES)
+    if counts:
+        bulk_upsert(Rollup._get_collection(), [
+            _upsert(key, {'$inc': {'count': count}})
+            for key, count in counts.items()
+        ])
+
+
+def rebuild_rollups():
+    """Recomputes all buckets from raw history with aggregation pipelines."""
+    Rollup.drop_collection()
+    Rollup.ensure_indexes()
+
+    # Buckets never span months, so partitions are counted one by one.
+    for collection in collections():
+        for granularity, size in BUCKET_SIZES.items():
+            _rebuild(collection, granularity, size)
+
+
+def _rebuild(collection, granularity, size):
+    rows = collection.aggregate([
+        {'$group': {
+            '_id': {
+                'zone_id': '$zone_id',
+                'data_type': '$data_type',
+                'bucket': {'$subtract': [
+                    '$tracking_timestamp',
+                    {'$mod': ['$tracking_timestamp', size]}]}
+            },
+            'count': {'$sum': 1}
+        }}
+    ], allowDiskUse=True)
+
+    batch = []
+    for row in rows:
+        key = row['_id']
+        batch.append(_upsert(
+            (granularity, key['zone_id'], key['data_type'], key['bucket']),
+            {'$set': {'count': row['count']}}))
+        if len(batch) == BACKFILL_BATCH_SIZE:
+            Rollup._get_collection().bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        Rollup._get_collection().bulk_write(batch, ordered=False)
@@ -1,33 +1,108 @@
-from schema import Schema, And, Optional, Or, Use, Regex
-
-tracking_base = {
-    'tracking_id': And(
-        basestring, len, error='tracking_id should be non-empty string'),
-    'zone_id': And(
-        basestring, len, error='zone_id should be non-empty string'),
-    'data_type': Regex(
-        '(enter|leave|track)',
-        error='possible data_type values are: enter, leave, track'),
-    'tracking_timestamp': Use(
-        int, error='tracking_timestamp should be integer'),
-    'lat': Or(int, float, error='lat should be either int or float'),
-    'lon': Or(int, float, error='lon should be either int or float')
-}
-
-tracking_schema = Schema(tracking_base)
-
-bulk_tracking_schema = Schema({
-    'data': [tracking_base]
+from bson import ObjectId
+from schema import Schema, And, Optional, Use, Regex
+
+from constants import DATA_TYPES, ZONE_TYPES
+from helpers import decode_cursor
+from validators import (
+    Record, ListOf, non_empty_string, string, one_of, integer, instance_of)
+
+MAX_PAGE_SIZE = 10000
+NUMBER = (int, long, float)
+# Milliseconds of years 1 to 9999, the range `datetime` can represent.
+MIN_TIMESTAMP = -62135596800000
+MAX_TIMESTAMP = 253402300799999
+
+tracking_schema = Record({
+    'tracking_id': non_empty_string('tracking_id should be non-empty string'),
+    'zone_id': non_empty_string('zone_id should be non-empty string'),
+    'data_type': one_of(
+        DATA_TYPES, 'possible data_type values are: enter, leave, track'),
+    'tracking_timestamp': integer(
+        'tracking_timestamp should be integer', MIN_TIMESTAMP, MAX_TIMESTAMP),
+    'lat': instance_of(NUMBER, 'lat should be either int or float'),
+    'lon': instance_of(NUMBER, 'lon should be either int or float')
 })
 
-zone_schema = Schema({
-    'name': And(basestring, len, error='name should be non-empty string'),
-    Optional('description'): And(basestring, len),
-    'zone_type': Regex(
-        '(control|checkpoint)',
-        error='possible zone_type values are: control, checkpoint'),
-    Optional('image'): And(basestring),
-    'lat': Or(int, float, error='lat should be either int or float'),
-    'lon': Or(int, float, error='lon should be either int or float'),
-    'radius': Or(int, error='radius should be int')
+# Items are validated one by one, so one bad point doesn't fail the batch.
+bulk_tracking_schema = Record({
+    'data': ListOf(tracking_schema).validate_each
 })
+
+zone_schema = Record({
+    'name': non_empty_string('name should be non-empty string'),
+    'description': non_empty_string('description should be non-empty string'),
+    'zone_type': one_of(
+        ZONE_TYPES, 'possible zone_type values are: control, checkpoint'),
+    'image': string('image should be string'),
+    'lat': instance_of(NUMBER, 'lat should be either int or float'),
+    'lon': instance_of(NUMBER, 'lon should be either int or float'),
+    'radius': instance_of(int, 'radius should be int')
+}, optional=('description', 'image'))
+
+tracking_data_params_schema = Schema({
+    Optional('data_type'): basestring,
+    Optional('zone_id'): Use(
+        ObjectId, error='zone_id should be valid object id'),
+    Optional('from'): Use(int, error='from should be integer'),
+    Optional('to'): Use(int, error='to should be integer'),
+    Optional('limit'): And(
+        Use(int), lambda n: n > 0, error='limit should be positive integer'),
+    Optional('explain'): basestring,
+    Optional('cursor'): Use(decode_cursor),
+    Optional('page_size'): And(
+        Use(int), lambda n: 0 < n <= MAX_PAGE_SIZE,
+        error='page_size should be integer from 1 to {}'.format(
+            MAX_PAGE_SIZE)),
+    Optional('format'): Regex(
+        '^(json|ndjson|columnar|polyline)$',
+        error='possible format values are: json, ndjson, columnar, polyline'),
+    Optional('tolerance'): And(
+        Use(float), lambda n: n > 0,
+        error='tolerance should be positive number'),
+    Optional('max_points'): And(
+        Use(int), lambda n: n > 0,
+        error='max_points should be positive integer')
+}, ignore_extra_keys=True)
+
+zones_near_params_schema = Schema({
+    'lat': Use(float, error='lat should be number'),
+    'lon': Use(float, error='lon should be number'),
+    Optional('max_distance'): And(
+        Use(float), lambda n: n >= 0,
+        error='max_distance should be non-negative number')
+}, ignore_extra_keys=True)
+
+timeseries_params_schema = Schema({
+    Optional('granularity'): Regex(
+        '^(minute|hour|day)$',
+        error='possible granularity values are: minute, hour, day'),
+    Optional('zone_id'): Use(
+        ObjectId, error='zone_id should be valid object id'),
+    Optional('data_type'): basestring,
+    Optional('from'): Use(int, error='from should be integer'),
+    Optional('to'): Use(int, error='to should be integer')
+}, ignore_extra_keys=True)
+
+tracking_feed_params_schema = Schema({
+    Optional('tracking_id'): basestring,
+    Optional('zone_id'): Use(
+        ObjectId, error='zone_id should be valid object id'),
+    Optional('last_event_id'): Use(
+        ObjectId, error='last_event_id should be valid object id')
+}, ignore_extra_keys=True)
+
+tracking_data_delete_params_schema = Schema({
+    Optional('data_type'): basestring,
+    Optional('zone_id'): Use(
+        ObjectId, error='zone_id should be valid object id'),
+    Optional('from'): Use(int, error='from should be integer'),
+    Optional('to'): Use(int, error='to should be integer'),
+    Optional('background'): basestring
+}, ignore_extra_keys=True)
+
+positions_params_schema = Schema({
+    Optional('zone_id'): Use(
+        ObjectId, error='zone_id should be valid object id'),
+    Optional('max_age'): And(
+        Use(int), lambda n: n > 0, error='max_age should be positive integer')
+}, ignore_extra_keys=True)
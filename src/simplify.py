@@ -0,0 +1,99 @@
+"""Simplification and compact encoding of device paths for maps.
+
+Paths are lists of raw `tracking` rows sorted by `tracking_timestamp`.
+"""
+from math import cos, radians
+
+from geo import METERS_PER_DEGREE
+
+
+def _project(rows):
+    """Returns x and y coordinates in meters, good enough for short paths."""
+    lat = radians(sum(row['lat'] for row in rows) / len(rows))
+    kx = METERS_PER_DEGREE * cos(lat)
+    return ([row['lon'] * kx for row in rows],
+            [row['lat'] * METERS_PER_DEGREE for row in rows])
+
+
+def douglas_peucker(rows, tolerance):
+    """Drops points closer than `tolerance` meters to the simplified path."""
+    if len(rows) < 3:
+        return rows
+
+    xs, ys = _project(rows)
+    keep = [False] * len(rows)
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+    stack = [(0, len(rows) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = xs[first], ys[first]
+        dx, dy = xs[last] - x1, ys[last] - y1
+        length2 = dx * dx + dy * dy
+
+        farthest, index = 0, None
+        for i in xrange(first + 1, last):
+            px, py = xs[i] - x1, ys[i] - y1
+            if length2:
+                t = min(max((px * dx + py * dy) / length2, 0), 1)
+                px, py = px - t * dx, py - t * dy
+            distance2 = px * px + py * py
+            if distance2 > farthest:
+                farthest, index = distance2, i
+
+        if farthest > tolerance2:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [row for row, kept in zip(rows, keep) if kept]
+
+
+def decimate(rows, max_points):
+    """Keeps the first point of equal time buckets, and the last point."""
+    if len(rows) <= max_points:
+        return rows
+    if max_points < 2:
+        return rows[:max_points]
+
+    first = rows[0]['tracking_timestamp']
+    span = rows[-1]['tracking_timestamp'] - first + 1
+    buckets = max_points - 1
+    kept, bucket = [], None
+    for row in rows[:-1]:
+        current = (row['tracking_timestamp'] - first) * buckets // span
+        if current != bucket:
+            kept.append(row)
+            bucket = current
+    kept.append(rows[-1])
+    return kept
+
+
+def simplify(rows, tolerance=None, max_points=None):
+    """Applies Douglas-Peucker, then time decimation, whichever is given."""
+    if tolerance:
+        rows = douglas_peucker(rows, tolerance)
+    if max_points:
+        rows = decimate(rows, max_points)
+    return rows
+
+
+def _encode_number(value, chunks):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+
+def encode_polyline(rows, precision=5):
+    """Encodes a path with the delta-encoded Google polyline algorithm."""
+    factor = 10 ** precision
+    chunks = []
+    previous_lat = previous_lon = 0
+    for row in rows:
+        lat = int(round(row['lat'] * factor))
+        lon = int(round(row['lon'] * factor))
+        _encode_number(lat - previous_lat, chunks)
+        _encode_number(lon - previous_lon, chunks)
+        previous_lat, previous_lon = lat, lon
+    return ''.join(chunks)
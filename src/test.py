@@ -1,20 +1,48 @@
 import json
+import os
 import time
 import unittest
+from datetime import datetime
+from flask import jsonify
 from mongoengine.fields import ObjectId
 from mongoengine.connection import _get_db
-from app import app
-from models import Tracking, Zone
+from pymongo.errors import AutoReconnect, BulkWriteError
+from schema import SchemaError
+from app import app, create_app, write_behind
+from database import bulk_upsert, read_preference, write_concern
+from encoders import ENCODERS, get_encoder
+from export import decode_points, encode_points
+from feed import events
+from metrics import Histogram
+from geo import ZoneGrid, distance
+from geofence import _save_states
+from models import (
+    Tracking, Zone, FeedEvent, LastPosition, ensure_indexes,
+    serialize_points, zone_cache)
+from occupancy import rebuild_occupancy
+import partitions
+from positions import rebuild_positions
+from retention import purge
+from rollups import rebuild_rollups
+from schemas import (
+    MAX_TIMESTAMP, tracking_schema, bulk_tracking_schema, zone_schema)
+from simplify import decimate, douglas_peucker, encode_polyline
+from writebehind import WriteBehind
 
 from constants import DataTypes, ZoneTypes
 
 
+def setUpModule():
+    ensure_indexes()
+
+
 class KolejkaTest(unittest.TestCase):
     def setUp(self):
         app.debug = True
         self.app = app.test_client()
         _get_db().tracking.remove()
         _get_db().zone.remove()
+        zone_cache.invalidate()
 
     def tearDown(self):
         pass
@@ -275,6 +303,7 @@ class TestGetTrackingDataForTrackingID(unittest.TestCase):
         self.app = app.test_client()
         _get_db().tracking.remove()
         _get_db().zone.remove()
+        zone_cache.invalidate()
 
         tracking_time = time.time()
 
@@ -339,6 +368,7 @@ class TestGetTrackingDataForAllIDs(unittest.TestCase):
         self.app = app.test_client()
         _get_db().tracking.remove()
         _get_db().zone.remove()
+        zone_cache.invalidate()
 
         tracking_time = time.time()
 
@@ -385,6 +415,7 @@ class TestDeleteTrackingDataForAllIDs(unittest.TestCase):
         self.app = app.test_client()
         _get_db().tracking.remove()
         _get_db().zone.remove()
+        zone_cache.invalidate()
 
         tracking_time = time.time()
 
@@ -418,6 +449,7 @@ class TestGetActiveZones(unittest.TestCase):
         self.app = app.test_client()
         _get_db().tracking.remove()
         _get_db().zone.remove()
+        zone_cache.invalidate()
 
         self.zone = Zone.objects.create(
             name='test', zone_type=ZoneTypes.control, lat=10, lon=10,
@@ -448,3 +480,1198 @@ class TestCanCreateZoneWithoutOptionalFields(unittest.TestCase):
 
     def test_zone_is_created(self):
         self.assertEquals(self.result.status_code, 200)
+
+
+class TestZoneNameCache(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+
+        payload = {
+            'name': 'Grushiv',
+            'zone_type': ZoneTypes.control,
+            'lat': 10.5,
+            'lon': 20,
+            'radius': 3000
+        }
+        res = self.app.post('/v1/zones',
+                            data=json.dumps(payload),
+                            content_type='application/json')
+        self.zone_id = json.loads(res.data)['data']['id']
+
+        Tracking.objects.create(
+            tracking_id='phone1',
+            zone_id=self.zone_id,
+            data_type=DataTypes.enter,
+            lat=10.1,
+            lon=10.2,
+            tracking_timestamp=100000
+        )
+
+    def get_zone_name(self):
+        res = self.app.get('/v1/tracking-data/phone1')
+        return json.loads(res.data)['data'][0]['zone_name']
+
+    def test_zone_name_is_resolved(self):
+        self.assertEqual(self.get_zone_name(), 'Grushiv')
+
+    def test_deleted_zone_name_is_not_resolved(self):
+        self.assertEqual(self.get_zone_name(), 'Grushiv')
+        self.app.delete('/v1/zones/{id}'.format(id=self.zone_id))
+        self.assertEqual(self.get_zone_name(), self.zone_id)
+
+
+class TestBulkTrackingPartialFailure(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+
+        self.payload = json.dumps({
+            'data': [
+                {
+                    'tracking_id': 'track_id',
+                    'data_type': DataTypes.enter,
+                    'zone_id': str(ObjectId()),
+                    'tracking_timestamp': 100000,
+                    'lat': 10.0,
+                    'lon': 20.0
+                },
+                {
+                    'tracking_id': 'track_id',
+                    'data_type': DataTypes.leave,
+                    'zone_id': 'not-an-object-id',
+                    'tracking_timestamp': 100001,
+                    'lat': 10.5,
+                    'lon': 20.5
+                }
+            ]})
+
+    def test_valid_points_are_saved(self):
+        res = self.app.post('/v1/bulk_tracking',
+                            data=self.payload,
+                            content_type='application/json')
+        self.assertEquals(res.status_code, 200)
+        body = json.loads(res.data)
+        self.assertEquals(body['status'], 'success')
+        self.assertEquals(len(body['data']), 1)
+        self.assertEquals(body['data'][0]['tracking_timestamp'], 100000)
+        self.assertEquals(len(body['errors']), 1)
+        self.assertEquals(body['errors'][0]['index'], 1)
+        self.assertEqual(len(Tracking.objects.all()), 1)
+
+    def test_schema_errors_are_reported_per_item(self):
+        payload = json.loads(self.payload)
+        payload['data'].insert(0, {'data_type': 'xenterx'})
+        res = self.app.post('/v1/bulk_tracking',
+                            data=json.dumps(payload),
+                            content_type='application/json')
+        self.assertEquals(res.status_code, 200)
+        body = json.loads(res.data)
+        self.assertEquals(
+            [point['tracking_timestamp'] for point in body['data']],
+            [100000])
+        self.assertEquals(
+            [error['index'] for error in body['errors']], [0, 2])
+        self.assertEquals(
+            body['errors'][0]['error'],
+            'possible data_type values are: enter, leave, track')
+
+    def test_ids_response(self):
+        res = self.app.post('/v1/bulk_tracking?response=ids',
+                            data=self.payload,
+                            content_type='application/json')
+        body = json.loads(res.data)
+        self.assertEquals(body['data']['count'], 1)
+        self.assertEquals(
+            body['data']['inserted_ids'], [str(Tracking.objects.get().id)])
+
+
+class TestTrackingDataPagination(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+
+        for i in range(3):
+            Tracking.objects.create(
+                tracking_id='phone1',
+                zone_id=str(ObjectId()),
+                data_type=DataTypes.track,
+                lat=10.1,
+                lon=10.2,
+                tracking_timestamp=100000 + i
+            )
+
+    def test_pages_follow_cursor(self):
+        body = json.loads(
+            self.app.get('/v1/tracking-data/ALL?page_size=2').data)
+        self.assertEqual(
+            [p['tracking_timestamp'] for p in body['data']],
+            [100000, 100001])
+        self.assertIsNotNone(body['next_cursor'])
+
+        body = json.loads(self.app.get(
+            '/v1/tracking-data/ALL?page_size=2&cursor={}'.format(
+                body['next_cursor'])).data)
+        self.assertEqual(
+            [p['tracking_timestamp'] for p in body['data']], [100002])
+        self.assertIsNone(body['next_cursor'])
+
+    def test_invalid_cursor(self):
+        res = self.app.get('/v1/tracking-data/ALL?cursor=wrong')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['data'], 'cursor is invalid')
+
+    def test_ndjson_export(self):
+        res = self.app.get('/v1/tracking-data/phone1?format=ndjson')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = res.data.strip().split('\n')
+        self.assertEqual(
+            [json.loads(line)['tracking_timestamp'] for line in lines],
+            [100000, 100001, 100002])
+
+
+class TestTrackingDataFilters(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+
+        self.zone_id = str(ObjectId())
+        for i in range(4):
+            Tracking.objects.create(
+                tracking_id='phone1',
+                zone_id=self.zone_id if i % 2 else str(ObjectId()),
+                data_type=DataTypes.track,
+                lat=10.1,
+                lon=10.2,
+                tracking_timestamp=100000 + i
+            )
+
+    def get_timestamps(self, query):
+        res = self.app.get('/v1/tracking-data/ALL?' + query)
+        self.assertEqual(res.status_code, 200)
+        return [p['tracking_timestamp'] for p in json.loads(res.data)['data']]
+
+    def test_time_range(self):
+        self.assertEqual(
+            self.get_timestamps('from=100001&to=100002'), [100001, 100002])
+
+    def test_zone_id(self):
+        self.assertEqual(
+            self.get_timestamps('zone_id=' + self.zone_id), [100001, 100003])
+
+    def test_limit(self):
+        self.assertEqual(self.get_timestamps('limit=1'), [100000])
+
+    def test_explain_shows_index(self):
+        res = self.app.get(
+            '/v1/tracking-data/ALL?explain=1&zone_id=' + self.zone_id)
+        body = json.loads(res.data)
+        self.assertIn(
+            'zone_id_1_tracking_timestamp_1__id_1', body['data']['indexes'])
+        self.assertNotIn('SORT', body['data']['stages'])
+
+    def test_device_history_is_sorted_by_index(self):
+        res = self.app.get('/v1/tracking-data/phone1?explain=1')
+        self.assertNotIn('SORT', json.loads(res.data)['data']['stages'])
+
+    def test_invalid_params(self):
+        res = self.app.get('/v1/tracking-data/ALL?from=yesterday')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            json.loads(res.data)['data'], 'from should be integer')
+
+
+class TestRawSerialization(unittest.TestCase):
+    def setUp(self):
+        _get_db().tracking.remove()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+
+        zone = Zone.objects.create(
+            name='test', zone_type=ZoneTypes.control, lat=10, lon=10,
+            radius=10)
+        for i, zone_id in enumerate((zone.id, ObjectId())):
+            Tracking.objects.create(
+                tracking_id='phone1',
+                zone_id=zone_id,
+                data_type=DataTypes.track,
+                lat=10.1,
+                lon=10.2,
+                tracking_timestamp=int(time.time() * 1000) + i
+            )
+
+    def test_matches_as_dict(self):
+        data = Tracking.objects.order_by('tracking_timestamp')
+        rows = data.only(*Tracking.serialized_fields).as_pymongo()
+        self.assertEqual(
+            list(serialize_points(rows)), [p.as_dict() for p in data])
+
+
+class TestEncoders(unittest.TestCase):
+    def setUp(self):
+        self.payload = {
+            'id': ObjectId('58a1b2c3d4e5f6a7b8c9d0e1'),
+            'created_at': datetime(2017, 2, 13, 10, 20, 30),
+            'values': [1, 2.5, None, True]
+        }
+
+    def test_matches_flask_jsonify(self):
+        expected = dict(self.payload, id=str(self.payload['id']))
+        with app.test_request_context():
+            flask_body = json.loads(jsonify(expected).data)
+
+        for name in ENCODERS:
+            try:
+                dumps = get_encoder(name)
+            except ImportError:
+                continue
+            self.assertEqual(json.loads(dumps(self.payload)), flask_body)
+            self.assertEqual(
+                json.loads(dumps(self.payload, compact=False)), flask_body)
+
+    def test_compact(self):
+        self.assertNotIn(' ', get_encoder('json')({'a': [1, 2]}))
+
+
+class TestZoneGrid(unittest.TestCase):
+    def setUp(self):
+        self.zones = [
+            {'_id': 1, 'lat': 49.8350, 'lon': 24.0206, 'radius': 100},
+            {'_id': 2, 'lat': 49.8355, 'lon': 24.0206, 'radius': 100},
+            {'_id': 3, 'lat': 50.4501, 'lon': 30.5234, 'radius': 5000},
+        ]
+        self.grid = ZoneGrid(self.zones)
+
+    def containing(self, lat, lon):
+        return sorted(z['_id'] for z in self.grid.containing(lat, lon))
+
+    def test_overlapping_zones(self):
+        self.assertEqual(self.containing(49.8352, 24.0206), [1, 2])
+        self.assertEqual(self.containing(49.8345, 24.0206), [1])
+
+    def test_large_zone_spans_cells(self):
+        self.assertEqual(self.containing(50.4801, 30.5234), [3])
+        self.assertEqual(self.containing(50.5001, 30.5234), [])
+
+    def test_distance(self):
+        self.assertAlmostEqual(
+            distance(49.8350, 24.0206, 49.8355, 24.0206), 55.6, places=1)
+
+
+class TestGeofenceEvents(unittest.TestCase):
+    def setUp(self):
+        app.config['GEOFENCE_EVENTS'] = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+        _get_db().geofence_state.remove()
+
+        payload = {
+            'name': 'gate',
+            'zone_type': ZoneTypes.checkpoint,
+            'lat': 49.8350,
+            'lon': 24.0206,
+            'radius': 100
+        }
+        res = self.app.post('/v1/zones',
+                            data=json.dumps(payload),
+                            content_type='application/json')
+        self.zone_id = json.loads(res.data)['data']['id']
+
+        self.payload = {'data': [{
+            'tracking_id': 'phone1',
+            'data_type': DataTypes.track,
+            'zone_id': str(ObjectId()),
+            'tracking_timestamp': 100000 + i,
+            'lat': lat,
+            'lon': 24.0206
+        } for i, lat in enumerate((49.8300, 49.8350, 49.8351, 49.8400))]}
+
+    def tearDown(self):
+        app.config['GEOFENCE_EVENTS'] = False
+
+    def test_enter_and_leave_are_derived(self):
+        self.app.post('/v1/bulk_tracking',
+                      data=json.dumps(self.payload),
+                      content_type='application/json')
+
+        events = Tracking.objects.filter(
+            data_type__in=[DataTypes.enter, DataTypes.leave]).order_by(
+                'tracking_timestamp')
+        self.assertEqual(
+            [(e.data_type, str(e.zone_id), e.tracking_timestamp)
+             for e in events],
+            [(DataTypes.enter, self.zone_id, 100001),
+             (DataTypes.leave, self.zone_id, 100003)])
+
+    def test_older_state_is_not_stored(self):
+        for timestamp in (200000, 100000):
+            _save_states([{
+                '_id': 'phone1',
+                'zone_ids': [],
+                'tracking_timestamp': timestamp
+            }])
+        self.assertEqual(
+            _get_db().geofence_state.find_one()['tracking_timestamp'], 200000)
+
+    def test_out_of_order_point_is_ignored(self):
+        self.app.post('/v1/bulk_tracking',
+                      data=json.dumps(self.payload),
+                      content_type='application/json')
+
+        late = dict(self.payload['data'][1], tracking_timestamp=99999)
+        res = self.app.post('/v1/tracking',
+                            data=json.dumps(late),
+                            content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Tracking.objects.filter(
+            data_type=DataTypes.enter).count(), 1)
+
+
+class TestZonesNear(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+
+        for name, lat in (('gate', 49.8350), ('hall', 49.8400)):
+            payload = {
+                'name': name,
+                'zone_type': ZoneTypes.checkpoint,
+                'lat': lat,
+                'lon': 24.0206,
+                'radius': 100
+            }
+            self.app.post('/v1/zones',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+
+    def get_zones(self, query):
+        res = self.app.get('/v1/zones/near?' + query)
+        self.assertEqual(res.status_code, 200)
+        return [(z['name'], z['inside']) for z in json.loads(res.data)['data']]
+
+    def test_containing_zones(self):
+        self.assertEqual(
+            self.get_zones('lat=49.8351&lon=24.0206'), [('gate', True)])
+        self.assertEqual(self.get_zones('lat=49.8375&lon=24.0206'), [])
+
+    def test_zones_within_distance(self):
+        self.assertEqual(
+            self.get_zones('lat=49.8370&lon=24.0206&max_distance=150'),
+            [('gate', False)])
+        self.assertEqual(
+            self.get_zones('lat=49.8370&lon=24.0206&max_distance=250'),
+            [('gate', False), ('hall', False)])
+
+    def test_location_is_not_exposed(self):
+        zone = json.loads(self.app.get('/v1/zones').data)['data'][0]
+        self.assertNotIn('location', zone)
+
+
+class TestZoneStats(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        _get_db().presence.remove()
+        _get_db().zone_stats.remove()
+
+        self.zone_id = str(ObjectId())
+        events = [
+            ('phone1', DataTypes.enter, 100000),
+            ('phone2', DataTypes.enter, 101000),
+            ('phone1', DataTypes.enter, 102000),
+            ('phone1', DataTypes.leave, 105000),
+            ('phone3', DataTypes.leave, 106000),
+        ]
+        payload = {'data': [{
+            'tracking_id': tracking_id,
+            'data_type': data_type,
+            'zone_id': self.zone_id,
+            'tracking_timestamp': tracking_timestamp,
+            'lat': 10.0,
+            'lon': 20.0
+        } for tracking_id, data_type, tracking_timestamp in events]}
+        self.app.post('/v1/bulk_tracking',
+                      data=json.dumps(payload),
+                      content_type='application/json')
+
+    def get_stats(self):
+        res = self.app.get('/v1/zones/{}/stats'.format(self.zone_id))
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['data']
+
+    def test_counters(self):
+        self.assertEqual(self.get_stats(), {
+            'zone_id': self.zone_id,
+            'occupancy': 1,
+            'enters': 3,
+            'leaves': 2,
+            'average_dwell_time': 5000
+        })
+
+    def test_rebuild(self):
+        before = self.get_stats()
+        rebuild_occupancy()
+        self.assertEqual(self.get_stats(), before)
+
+    def test_unknown_zone(self):
+        self.zone_id = str(ObjectId())
+        self.assertEqual(self.get_stats()['occupancy'], 0)
+
+
+class TestTimeseries(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        _get_db().rollup.remove()
+
+        self.zone_id = str(ObjectId())
+        hour = 60 * 60 * 1000
+        payload = {'data': [{
+            'tracking_id': 'phone1',
+            'data_type': DataTypes.track,
+            'zone_id': self.zone_id,
+            'tracking_timestamp': tracking_timestamp,
+            'lat': 10.0,
+            'lon': 20.0
+        } for tracking_timestamp in (hour, hour + 1000, 2 * hour + 5000)]}
+        self.app.post('/v1/bulk_tracking',
+                      data=json.dumps(payload),
+                      content_type='application/json')
+
+    def get_counts(self, query):
+        res = self.app.get('/v1/stats/timeseries?' + query)
+        self.assertEqual(res.status_code, 200)
+        rollups = json.loads(res.data)['data']
+        return [(r['bucket'], r['count']) for r in rollups]
+
+    def test_hourly_buckets(self):
+        self.assertEqual(
+            self.get_counts('granularity=hour&zone_id=' + self.zone_id),
+            [(3600000, 2), (7200000, 1)])
+
+    def test_range(self):
+        # Buckets overlapping the inclusive from/to range are returned.
+        self.assertEqual(
+            self.get_counts('granularity=minute&from=3600500&to=7199999'),
+            [(3600000, 2)])
+        self.assertEqual(
+            self.get_counts('granularity=minute&from=3600500&to=7200000'),
+            [(3600000, 2), (7200000, 1)])
+
+    def test_rebuild(self):
+        before = self.get_counts('granularity=day')
+        rebuild_rollups()
+        self.assertEqual(self.get_counts('granularity=day'), before)
+        self.assertEqual(before, [(0, 3)])
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+        self.buffer = WriteBehind(
+            self.written.append, max_size=5, batch_size=2, interval=0.01)
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def test_backpressure(self):
+        # Keeps the flusher from draining the buffer in between.
+        self.buffer.batch_size = 10
+        self.buffer.interval = 60
+        self.assertTrue(self.buffer.put([1, 2, 3]))
+        self.assertFalse(self.buffer.put([4, 5, 6]))
+
+    def test_flushes_in_batches(self):
+        self.buffer.put([1, 2, 3])
+        self.buffer.flush()
+        self.assertEqual(self.written, [[1, 2], [3]])
+        self.assertEqual(self.buffer.stats()['flushed'], 3)
+        self.assertEqual(self.buffer.stats()['depth'], 0)
+
+    def test_background_flush(self):
+        self.buffer.put([1])
+        time.sleep(0.1)
+        self.assertEqual(self.written, [[1]])
+
+    def test_close_flushes(self):
+        self.buffer.interval = 60
+        self.buffer.put([1])
+        self.buffer.close()
+        self.assertEqual(self.written, [[1]])
+
+    def test_failed_batch_is_retried(self):
+        failures = [AutoReconnect('stepdown')]
+
+        def write(batch):
+            if failures:
+                raise failures.pop()
+            self.written.append(batch)
+
+        self.buffer.write = write
+        self.buffer.backoff = 0
+        self.buffer.put([1, 2, 3])
+        self.buffer.flush()
+        self.assertEqual(self.written, [[1, 2], [3]])
+        self.assertEqual(self.buffer.stats()['retried'], 2)
+        self.assertEqual(self.buffer.stats()['failed'], 0)
+
+    def test_gives_up_after_max_retries(self):
+        def write(batch):
+            raise AutoReconnect('down')
+
+        self.buffer.write = write
+        self.buffer.backoff = 0
+        self.buffer.max_retries = 2
+        self.buffer.put([1])
+        self.buffer.flush()
+        self.assertEqual(self.buffer.stats()['failed'], 1)
+        self.assertEqual(self.buffer.stats()['depth'], 0)
+
+    def test_failing_item_is_isolated(self):
+        def write(batch):
+            if 2 in batch:
+                raise OverflowError('bad item')
+            self.written.append(batch)
+
+        self.buffer.write = write
+        self.buffer.put([1, 2, 3])
+        self.buffer.flush()
+        self.assertEqual(sorted(sum(self.written, [])), [1, 3])
+        self.assertEqual(self.buffer.stats()['failed'], 1)
+        self.assertEqual(self.buffer.stats()['retried'], 0)
+
+
+class TestWriteBehindTracking(unittest.TestCase):
+    def setUp(self):
+        app.config['WRITE_BEHIND'] = True
+        self.app = app.test_client()
+        self.payload = json.dumps({
+            'zone_id': str(ObjectId()),
+            'data_type': DataTypes.enter,
+            'tracking_id': 'track_id',
+            'tracking_timestamp': 100000,
+            'lat': 10.0,
+            'lon': 20.0
+        })
+
+    def tearDown(self):
+        app.config['WRITE_BEHIND'] = False
+        write_behind.max_size = 50000
+
+    def test_point_is_written_later(self):
+        _get_db().tracking.remove()
+        res = self.app.post('/v1/tracking',
+                            data=self.payload,
+                            content_type='application/json')
+        self.assertEqual(res.status_code, 202)
+        point_id = json.loads(res.data)['data']['id']
+
+        write_behind.flush()
+        self.assertEqual(str(Tracking.objects.get().id), point_id)
+
+    def test_full_queue(self):
+        write_behind.max_size = 0
+        res = self.app.post('/v1/tracking',
+                            data=self.payload,
+                            content_type='application/json')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+
+class TestTrackingFeed(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        FeedEvent.drop_collection()
+
+        for tracking_id in ('phone1', 'phone2'):
+            payload = {
+                'zone_id': str(ObjectId()),
+                'data_type': DataTypes.track,
+                'tracking_id': tracking_id,
+                'tracking_timestamp': 100000,
+                'lat': 10.0,
+                'lon': 20.0
+            }
+            self.app.post('/v1/tracking',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+
+    def test_events_are_filtered(self):
+        feed = events({'tracking_id': 'phone2'}, ObjectId('0' * 24))
+        event = next(feed)
+        feed.close()
+
+        event_id, data = event.strip().split('\n')
+        self.assertEqual(
+            event_id, 'id: {}'.format(FeedEvent.objects.get(
+                tracking_id='phone2').id))
+        self.assertEqual(json.loads(data[len('data: '):])['tracking_id'],
+                         'phone2')
+
+    def test_resume_follows_storage_order(self):
+        # Ids made by different processes are not ordered like the events.
+        newer, older = ObjectId('f' * 24), ObjectId('1' * 24)
+        for event_id in (newer, older):
+            FeedEvent._get_collection().insert_one({
+                '_id': event_id,
+                'tracking_id': 'phone4',
+                'zone_id': ObjectId(),
+                'point': {'tracking_id': 'phone4'}
+            })
+
+        feed = events({'tracking_id': 'phone4'}, newer)
+        event = next(feed)
+        feed.close()
+        self.assertEqual(event.split('\n')[0], 'id: {}'.format(older))
+
+    def test_feed_resumes_from_last_event_id(self):
+        res = self.app.get('/v1/tracking-feed/last-event-id')
+        last_event_id = json.loads(res.data)['data']['last_event_id']
+        self.assertEqual(last_event_id, str(FeedEvent.objects.get(
+            tracking_id='phone2').id))
+
+        self.app.post('/v1/tracking', data=json.dumps({
+            'zone_id': str(ObjectId()),
+            'data_type': DataTypes.track,
+            'tracking_id': 'phone3',
+            'tracking_timestamp': 100000,
+            'lat': 10.0,
+            'lon': 20.0
+        }), content_type='application/json')
+
+        res = self.app.get(
+            '/v1/tracking-feed?last_event_id=' + last_event_id)
+        event = next(iter(res.response))
+        res.close()
+        self.assertIn('"tracking_id":"phone3"', event.replace(' ', ''))
+
+
+class TestValidators(unittest.TestCase):
+    def setUp(self):
+        self.point = {
+            'tracking_id': 'track_id',
+            'data_type': DataTypes.enter,
+            'zone_id': str(ObjectId()),
+            'tracking_timestamp': '100000',
+            'lat': 10,
+            'lon': 20.0
+        }
+
+    def assertError(self, schema, data, msg):
+        with self.assertRaises(SchemaError) as ctx:
+            schema.validate(data)
+        self.assertEqual(ctx.exception.message, msg)
+
+    def test_valid_point(self):
+        self.assertEqual(
+            tracking_schema.validate(self.point),
+            dict(self.point, tracking_timestamp=100000))
+
+    def test_data_type_is_matched_exactly(self):
+        self.point['data_type'] = 'xenterx'
+        self.assertError(
+            tracking_schema, self.point,
+            'possible data_type values are: enter, leave, track')
+
+    def test_wrong_keys(self):
+        self.point['extra'] = 1
+        self.assertError(
+            tracking_schema, {'extra': 1, 'zone_id': 'z'},
+            "Missing keys: 'data_type', 'lat', 'lon', 'tracking_id', "
+            "'tracking_timestamp'")
+        with self.assertRaises(SchemaError):
+            tracking_schema.validate(self.point)
+
+    def test_bulk_items(self):
+        points, errors = bulk_tracking_schema.validate(
+            {'data': [self.point, 1]})['data']
+        self.assertEqual(points, [tracking_schema.validate(self.point)])
+        self.assertEqual(
+            errors, [{'index': 1, 'error': "1 should be instance of 'dict'"}])
+        self.assertError(
+            bulk_tracking_schema, {'data': {}},
+            "{} should be instance of 'list'")
+
+    def test_zone_type(self):
+        self.assertError(
+            zone_schema, {
+                'name': 'test', 'zone_type': 'controls', 'lat': 1, 'lon': 1,
+                'radius': 1},
+            'possible zone_type values are: control, checkpoint')
+
+    def test_infinite_timestamp(self):
+        self.point['tracking_timestamp'] = float('inf')
+        self.assertError(
+            tracking_schema, self.point,
+            'tracking_timestamp should be integer')
+
+    def test_timestamp_out_of_range(self):
+        for timestamp in (1e20, 2 ** 63, MAX_TIMESTAMP + 1):
+            self.point['tracking_timestamp'] = timestamp
+            self.assertError(
+                tracking_schema, self.point,
+                'tracking_timestamp should be integer')
+
+
+class TestFilteredDelete(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+
+        for i in range(5):
+            Tracking.objects.create(
+                tracking_id='phone{}'.format(i % 2),
+                zone_id=str(ObjectId()),
+                data_type=DataTypes.track,
+                lat=10.1,
+                lon=10.2,
+                tracking_timestamp=100000 + i
+            )
+
+    def test_delete_time_range(self):
+        res = self.app.delete('/v1/tracking-data/ALL?from=100001&to=100003')
+        self.assertEqual(json.loads(res.data)['data'], {'deleted': 3})
+        self.assertEqual(
+            sorted(p.tracking_timestamp for p in Tracking.objects.all()),
+            [100000, 100004])
+
+    def test_delete_tracking_id_in_batches(self):
+        purge(Tracking.objects(tracking_id='phone0'), batch_size=2)
+        self.assertEqual(
+            set(p.tracking_id for p in Tracking.objects.all()), {'phone1'})
+
+    def test_delete_in_background(self):
+        res = self.app.delete('/v1/tracking-data/phone1?background=1')
+        self.assertEqual(res.status_code, 202)
+        for _ in range(50):
+            if not Tracking.objects(tracking_id='phone1').count():
+                break
+            time.sleep(0.1)
+        self.assertEqual(Tracking.objects.count(), 3)
+
+
+class TestDatabaseOptions(unittest.TestCase):
+    def test_read_preference(self):
+        pref = read_preference('secondaryPreferred', 90)
+        self.assertEqual(pref.document, {
+            'mode': 'secondaryPreferred', 'maxStalenessSeconds': 90})
+        self.assertEqual(
+            read_preference('primary', 90).document, {'mode': 'primary'})
+
+    def test_write_concern(self):
+        self.assertEqual(write_concern('2').document, {'w': 2})
+        self.assertEqual(
+            write_concern('majority', journal=True).document,
+            {'w': 'majority', 'j': True})
+
+    def test_bulk_upsert_retries_duplicate_keys(self):
+        calls = []
+
+        class Collection(object):
+            def bulk_write(self, requests, ordered):
+                calls.append(requests)
+                if len(calls) == 1:
+                    raise BulkWriteError({'writeErrors': [
+                        {'index': 1, 'code': 11000, 'errmsg': 'E11000'}]})
+
+        bulk_upsert(Collection(), ['a', 'b', 'c'])
+        self.assertEqual(calls, [['a', 'b', 'c'], ['b']])
+
+    def test_pool_stats(self):
+        app.debug = True
+        res = app.test_client().get('/v1/db/pool')
+        pools = json.loads(res.data)['data']
+        self.assertTrue(pools)
+        self.assertTrue(all(
+            pool['in_use'] <= pool['max_size'] for pool in pools))
+
+
+class TestZonesConditionalGet(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().zone.remove()
+        zone_cache.invalidate()
+
+    def post_zone(self, name):
+        self.app.post('/v1/zones', data=json.dumps({
+            'name': name,
+            'zone_type': ZoneTypes.control,
+            'lat': 10.5,
+            'lon': 20,
+            'radius': 3000
+        }), content_type='application/json')
+
+    def test_not_modified(self):
+        self.post_zone('Grushiv')
+        res = self.app.get('/v1/zones')
+        etag = res.headers['ETag']
+
+        res = self.app.get('/v1/zones', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, '')
+
+    def test_etag_changes_with_zones(self):
+        self.post_zone('Grushiv')
+        etag = self.app.get('/v1/zones').headers['ETag']
+
+        self.post_zone('Kolejka')
+        res = self.app.get('/v1/zones', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(res.data)['data']), 2)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_histogram(self):
+        histogram = Histogram('latency', 'Latency.', ('route',), (0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(('/a',), value)
+        self.assertEqual(histogram.render()[2:], [
+            'latency_bucket{route="/a",le="0.1"} 1',
+            'latency_bucket{route="/a",le="1.0"} 3',
+            'latency_bucket{route="/a",le="+Inf"} 4',
+            'latency_sum{route="/a"} 6.05',
+            'latency_count{route="/a"} 4'])
+
+    def test_server_timing(self):
+        res = self.app.post('/v1/tracking')
+        self.assertEqual(res.status_code, 400)
+        phases = [timing.split(';')[0]
+                  for timing in res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['validate', 'db', 'total'])
+
+    def test_route_histogram(self):
+        self.app.post('/v1/tracking')
+        res = self.app.get('/metrics')
+        self.assertIn(
+            'http_request_duration_seconds_count{route="/v1/tracking",'
+            'method="POST",status="400",pid="%d"}' % os.getpid(), res.data)
+
+    def test_failed_request_is_recorded(self):
+        debug, app.debug = app.debug, False
+        try:
+            res = self.app.delete('/v1/zones/' + '0' * 24)
+        finally:
+            app.debug = debug
+        self.assertEqual(res.status_code, 500)
+        self.assertIn(
+            'route="/v1/zones/<id>",method="DELETE",status="500"',
+            self.app.get('/metrics').data)
+
+
+class TestColumnarExport(unittest.TestCase):
+    def setUp(self):
+        self.zone_id = ObjectId()
+        self.rows = [{
+            '_id': ObjectId(),
+            'tracking_id': 'phone{}'.format(i % 2),
+            'data_type': DataTypes.track,
+            'zone_id': self.zone_id,
+            'lat': 49.8350957 + i,
+            'lon': 24.0206744,
+            'tracking_timestamp': 1487000000000 + i,
+            'created_at': datetime(2017, 2, 13, 15, 33, 20, 123456)
+        } for i in range(3)]
+
+    def test_round_trip(self):
+        header, columns = decode_points(encode_points(self.rows))
+        self.assertEqual(header['rows'], 3)
+        self.assertEqual(columns['id'], [str(r['_id']) for r in self.rows])
+        self.assertEqual(
+            columns['tracking_id'], ['phone0', 'phone1', 'phone0'])
+        self.assertEqual(columns['zone_id'], [str(self.zone_id)] * 3)
+        self.assertEqual(columns['lat'], [r['lat'] for r in self.rows])
+        self.assertEqual(
+            columns['tracking_timestamp'],
+            [1487000000000, 1487000000001, 1487000000002])
+        self.assertEqual(columns['created_at'], [1487000000123] * 3)
+
+    def test_buffers_are_aligned(self):
+        payload = encode_points(self.rows)
+        header, _ = decode_points(payload)
+        start = len(payload) - sum(c['length'] for c in header['columns'])
+        self.assertEqual(start % 8, 0)
+        self.assertTrue(all(c['offset'] % 8 == 0 for c in header['columns']))
+
+    def test_empty(self):
+        header, columns = decode_points(encode_points([]))
+        self.assertEqual(header['rows'], 0)
+        self.assertEqual(columns['lat'], [])
+
+
+class TestSimplify(unittest.TestCase):
+    def setUp(self):
+        # A straight path north with a 50 meter detour east in the middle.
+        self.rows = [{
+            'lat': 49.8 + i * 0.0001,
+            'lon': 24.0 + (0.0007 if i == 50 else 0),
+            'tracking_timestamp': 100000 + i * 1000
+        } for i in range(101)]
+
+    def test_douglas_peucker(self):
+        kept = douglas_peucker(self.rows, 10)
+        self.assertEqual(
+            [row['tracking_timestamp'] for row in kept],
+            [100000, 149000, 150000, 151000, 200000])
+        self.assertEqual(len(douglas_peucker(self.rows, 100)), 2)
+
+    def test_decimate(self):
+        kept = decimate(self.rows, 5)
+        self.assertEqual(
+            [row['tracking_timestamp'] for row in kept],
+            [100000, 126000, 151000, 176000, 200000])
+        self.assertEqual(decimate(self.rows[:3], 5), self.rows[:3])
+
+    def test_polyline(self):
+        self.assertEqual(encode_polyline([
+            {'lat': 38.5, 'lon': -120.2},
+            {'lat': 40.7, 'lon': -120.95},
+            {'lat': 43.252, 'lon': -126.453}
+        ]), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+
+class TestTrackingPath(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+
+        for i in range(20):
+            Tracking.objects.create(
+                tracking_id='phone1',
+                zone_id=str(ObjectId()),
+                data_type=DataTypes.track,
+                lat=49.8 + i * 0.0001,
+                lon=24.0,
+                tracking_timestamp=100000 + i * 1000
+            )
+
+    def get(self, query, tracking_id='phone1'):
+        res = self.app.get(
+            '/v1/tracking-data/{}?{}'.format(tracking_id, query))
+        return res.status_code, json.loads(res.data)['data']
+
+    def test_straight_path_keeps_ends(self):
+        status, points = self.get('tolerance=5')
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            [p['tracking_timestamp'] for p in points], [100000, 119000])
+
+    def test_max_points(self):
+        _, points = self.get('max_points=4')
+        self.assertEqual(len(points), 4)
+
+    def test_polyline(self):
+        _, data = self.get('format=polyline&tolerance=5')
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['polyline'], encode_polyline([
+            {'lat': 49.8, 'lon': 24.0}, {'lat': 49.8019, 'lon': 24.0}]))
+
+    def test_needs_tracking_id(self):
+        status, msg = self.get('tolerance=5', tracking_id='ALL')
+        self.assertEqual(status, 400)
+        self.assertEqual(msg, (
+            'tolerance, max_points and polyline format need a tracking_id'))
+
+
+class TestIdempotentIngest(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+
+        self.point = {
+            'zone_id': str(ObjectId()),
+            'data_type': DataTypes.enter,
+            'tracking_id': 'track_id',
+            'tracking_timestamp': 100000,
+            'lat': 10.0,
+            'lon': 20.0
+        }
+
+    def post(self, url, payload):
+        res = self.app.post(url, data=json.dumps(payload),
+                            content_type='application/json')
+        return res.status_code, json.loads(res.data)
+
+    def test_tracking_retry(self):
+        _, first = self.post('/v1/tracking', self.point)
+        status, retry = self.post('/v1/tracking', self.point)
+        self.assertEqual(status, 200)
+        self.assertTrue(retry['duplicate'])
+        self.assertEqual(retry['data']['id'], first['data']['id'])
+        self.assertEqual(Tracking.objects.count(), 1)
+
+    def test_bulk_tracking_retry(self):
+        other = dict(self.point, data_type=DataTypes.leave)
+        _, first = self.post('/v1/bulk_tracking', {'data': [self.point]})
+        self.assertNotIn('duplicates', first)
+
+        status, retry = self.post(
+            '/v1/bulk_tracking', {'data': [self.point, other, other]})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(retry['data']), 1)
+        self.assertEqual(retry['duplicates'], [0, 2])
+        self.assertNotIn('errors', retry)
+        self.assertEqual(Tracking.objects.count(), 2)
+
+
+class TestLastPositions(unittest.TestCase):
+    def setUp(self):
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        LastPosition.objects.delete()
+
+        self.zone_id = str(ObjectId())
+        self.now = int(time.time() * 1000)
+
+    def post(self, *points):
+        self.app.post('/v1/bulk_tracking', data=json.dumps({'data': [{
+            'tracking_id': tracking_id,
+            'data_type': DataTypes.track,
+            'zone_id': zone_id,
+            'tracking_timestamp': timestamp,
+            'lat': 10.0,
+            'lon': 20.0
+        } for tracking_id, zone_id, timestamp in points]}),
+            content_type='application/json')
+
+    def get_positions(self, query=''):
+        res = self.app.get('/v1/positions?' + query)
+        return [(p['tracking_id'], p['tracking_timestamp'])
+                for p in json.loads(res.data)['data']]
+
+    def test_only_newer_points_move_devices(self):
+        self.post(('phone1', self.zone_id, 200), ('phone1', self.zone_id, 100))
+        self.assertEqual(self.get_positions(), [('phone1', 200)])
+        self.post(('phone1', self.zone_id, 150))
+        self.assertEqual(self.get_positions(), [('phone1', 200)])
+        self.post(('phone1', self.zone_id, 300))
+        self.assertEqual(self.get_positions(), [('phone1', 300)])
+
+    def test_filters(self):
+        self.post(('phone1', self.zone_id, self.now - 60 * 60 * 1000),
+                  ('phone2', self.zone_id, self.now),
+                  ('phone3', str(ObjectId()), self.now))
+        self.assertEqual(
+            self.get_positions('zone_id=' + self.zone_id),
+            [('phone1', self.now - 60 * 60 * 1000), ('phone2', self.now)])
+        self.assertEqual(
+            self.get_positions('zone_id={}&max_age=60'.format(self.zone_id)),
+            [('phone2', self.now)])
+
+    def test_rebuild(self):
+        self.post(('phone1', self.zone_id, 100), ('phone1', self.zone_id, 200),
+                  ('phone2', self.zone_id, 300))
+        LastPosition.objects.delete()
+        rebuild_positions()
+        self.assertEqual(
+            self.get_positions(), [('phone1', 200), ('phone2', 300)])
+
+
+class TestPartitions(unittest.TestCase):
+    FEBRUARY = 1485907200000
+
+    def setUp(self):
+        partitions.TRACKING_PARTITIONS = True
+        app.debug = True
+        self.app = app.test_client()
+        _get_db().tracking.remove()
+        partitions.drop_partitions()
+
+        self.timestamps = [self.FEBRUARY + i for i in (-2, -1, 0, 1, 2)]
+        self.app.post('/v1/bulk_tracking', data=json.dumps({'data': [{
+            'tracking_id': 'phone1',
+            'data_type': DataTypes.track,
+            'zone_id': str(ObjectId()),
+            'tracking_timestamp': timestamp,
+            'lat': 10.0,
+            'lon': 20.0
+        } for timestamp in reversed(self.timestamps)]}),
+            content_type='application/json')
+
+    def tearDown(self):
+        partitions.drop_partitions()
+        partitions.TRACKING_PARTITIONS = False
+
+    def test_dropped_partition_is_indexed_again(self):
+        _get_db()['tracking_2017_02'].drop()
+        partitions.collection_for(self.FEBRUARY)
+        self.assertIn(
+            'tracking_id_1_tracking_timestamp_1_data_type_1_zone_id_1',
+            _get_db()['tracking_2017_02'].index_information())
+
+    def test_partition_name(self):
+        self.assertEqual(
+            partitions.partition_name(self.FEBRUARY - 1), 'tracking_2017_01')
+        self.assertEqual(
+            partitions.partition_name(self.FEBRUARY), 'tracking_2017_02')
+
+    def test_points_are_stored_by_month(self):
+        self.assertEqual(partitions.partition_names(),
+                         ['tracking_2017_01', 'tracking_2017_02'])
+        self.assertEqual(
+            partitions.partition_names(start=self.FEBRUARY),
+            ['tracking_2017_02'])
+        self.assertEqual(Tracking.objects.count(), 0)
+
+    def test_pages_span_partitions(self):
+        res = self.app.get('/v1/tracking-data/phone1?page_size=3')
+        body = json.loads(res.data)
+        res = self.app.get('/v1/tracking-data/phone1?cursor={}'.format(
+            body['next_cursor']))
+        points = body['data'] + json.loads(res.data)['data']
+        self.assertEqual(
+            [p['tracking_timestamp'] for p in points], self.timestamps)
+
+    def test_delete_drops_whole_months(self):
+        res = self.app.delete(
+            '/v1/tracking-data/ALL?from={}'.format(self.FEBRUARY - 1))
+        self.assertEqual(json.loads(res.data)['data'], {'deleted': 4})
+        self.assertEqual(partitions.partition_names(), ['tracking_2017_01'])
+        self.assertEqual(
+            [p['tracking_timestamp'] for p in json.loads(self.app.get(
+                '/v1/tracking-data/ALL').data)['data']],
+            [self.FEBRUARY - 2])
+
+
+class TestAppFactory(unittest.TestCase):
+    def test_create_app(self):
+        other = create_app({'WRITE_BEHIND': True})
+        self.assertTrue(other.config['WRITE_BEHIND'])
+        self.assertFalse(other.config['MONGODB_SETTINGS']['connect'])
+        self.assertIn('ensure-indexes', other.cli.commands)
+        self.assertIn('/v1/zones', [
+            rule.rule for rule in other.url_map.iter_rules()])
+        self.assertIsNot(
+            other.extensions['write_behind'], write_behind)
+
+    def test_indexes_are_not_created_on_first_use(self):
+        for model in (Tracking, Zone, LastPosition):
+            self.assertFalse(model._meta['auto_create_index'])
@@ -0,0 +1,124 @@
+"""Single-pass validators for JSON payloads.
+
+Error messages and the order checks are made in follow the `schema`
+library, so the API reports the same errors; `SchemaError` is raised to
+keep `api_response` unaware of which validator is used.
+"""
+from schema import SchemaError
+
+
+def non_empty_string(error):
+    def check(value):
+        if isinstance(value, basestring) and value:
+            return value
+        raise SchemaError(error)
+    return check
+
+
+def string(error):
+    def check(value):
+        if isinstance(value, basestring):
+            return value
+        raise SchemaError(error)
+    return check
+
+
+def one_of(choices, error):
+    """Exact match against values of model `choices` pairs."""
+    values = frozenset(value for value, _ in choices)
+
+    def check(value):
+        if isinstance(value, basestring) and value in values:
+            return value
+        raise SchemaError(error)
+    return check
+
+
+def integer(error, minimum=-2 ** 63, maximum=2 ** 63 - 1):
+    """Integer within BSON's int64 range, or a tighter one."""
+    def check(value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError, OverflowError):
+            raise SchemaError(error)
+        if not minimum <= value <= maximum:
+            raise SchemaError(error)
+        return value
+    return check
+
+
+def instance_of(types, error):
+    def check(value):
+        if isinstance(value, types):
+            return value
+        raise SchemaError(error)
+    return check
+
+
+class Record(object):
+    """Validator of JSON objects with a fixed set of keys.
+
+    `fields` maps keys to functions returning the cleaned value or raising
+    `SchemaError`. Values are checked first, then missing and unknown keys.
+    """
+
+    def __init__(self, fields, optional=()):
+        self.fields = fields
+        self.required = frozenset(fields).difference(optional)
+
+    def validate(self, data):
+        if not isinstance(data, dict):
+            raise SchemaError('{!r} should be instance of {!r}'.format(
+                data, 'dict'))
+
+        fields = self.fields
+        new = {}
+        for key, value in data.iteritems():
+            check = fields.get(key)
+            if check is not None:
+                new[key] = check(value)
+
+        missing = self.required.difference(new)
+        if missing:
+            raise SchemaError('Missing keys: ' + ', '.join(
+                repr(key) for key in sorted(missing, key=repr)))
+
+        if len(new) != len(data):
+            wrong = set(data).difference(new)
+            raise SchemaError('Wrong keys {} in {!r}'.format(
+                ', '.join(repr(key) for key in sorted(wrong, key=repr)),
+                data))
+        return new
+
+
+class ListOf(object):
+    """Validator of JSON arrays whose items all match `validator`."""
+
+    def __init__(self, validator):
+        self.validator = validator
+
+    def _check(self, data):
+        if not isinstance(data, list):
+            raise SchemaError('{!r} should be instance of {!r}'.format(
+                data, 'list'))
+
+    def validate(self, data):
+        self._check(data)
+        validate = self.validator.validate
+        return [validate(item) for item in data]
+
+    def validate_each(self, data):
+        """Validates items one by one instead of failing on the first one.
+
+        Returns the valid items and a list of errors, each referring to an
+        item by its index.
+        """
+        self._check(data)
+        validate = self.validator.validate
+        items, errors = [], []
+        for index, item in enumerate(data):
+            try:
+                items.append(validate(item))
+            except SchemaError as ex:
+                errors.append({'index': index, 'error': ex.code})
+        return items, errors
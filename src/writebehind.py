@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from pymongo.errors import ConnectionFailure
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WriteBehind(object):
+    """Bounded in-process buffer flushed in batches by a background thread.
+
+    A batch is written when `batch_size` items are buffered or `interval`
+    seconds after the previous flush, whatever happens first. `put` refuses
+    items that would grow the buffer past `max_size`.
+
+    A batch failing with one of the `transient` errors goes back to the
+    front of the buffer and is retried after `backoff` seconds, doubled at
+    every attempt, up to `max_retries` times. A batch failing otherwise is
+    split in halves until the items that fail are isolated and dropped.
+    """
+
+    def __init__(self, write, max_size=50000, batch_size=500, interval=0.2,
+                 max_retries=5, backoff=0.5, transient=(ConnectionFailure,)):
+        self.write = write
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.transient = transient
+
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+        self.flushed = 0
+        self.failed = 0
+        self.retried = 0
+        self.last_flush_latency = None
+        self.max_flush_latency = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, items):
+        """Buffers all the items, or none of them if there is no room."""
+        with self._cond:
+            if len(self._items) + len(items) > self.max_size:
+                return False
+            self._items.extend(items)
+            if len(self._items) >= self.batch_size:
+                self._cond.notify()
+        self._ensure_started()
+        return True
+
+    def _ensure_started(self):
+        # Threads don't survive fork, so a worker starts its own flusher.
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while not self._closed:
+            with self._cond:
+                if len(self._items) < self.batch_size and not self._closed:
+                    self._cond.wait(self.interval)
+            self.flush()
+
+    def _next_batch(self):
+        with self._cond:
+            size = min(self.batch_size, len(self._items))
+            return [self._items.popleft() for _ in range(size)]
+
+    def _write(self, batch):
+        """Writes a batch, dropping only the items that fail for good."""
+        try:
+            self.write(batch)
+        except self.transient:
+            raise
+        except Exception:
+            if len(batch) == 1:
+                self.failed += 1
+                logger.exception('Dropped a buffered item failing to write')
+                return
+            middle = len(batch) // 2
+            self._write(batch[:middle])
+            self._write(batch[middle:])
+        else:
+            self.flushed += len(batch)
+
+    def flush(self):
+        """Writes out everything buffered so far."""
+        with self._flush_lock:
+            attempt = 0
+            batch = self._next_batch()
+            while batch:
+                started = time.time()
+                try:
+                    self._write(batch)
+                except self.transient:
+                    if attempt < self.max_retries:
+                        logger.warning(
+                            'Failed to write %d buffered items, retrying',
+                            len(batch), exc_info=True)
+                        with self._cond:
+                            self._items.extendleft(reversed(batch))
+                        self.retried += len(batch)
+                        time.sleep(self.backoff * 2 ** attempt)
+                        attempt += 1
+                        batch = self._next_batch()
+                        continue
+                    self.failed += len(batch)
+                    logger.exception(
+                        'Gave up writing %d buffered items', len(batch))
+                attempt = 0
+
+                self.last_flush_latency = time.time() - started
+                self.max_flush_latency = max(
+                    self.max_flush_latency, self.last_flush_latency)
+                batch = self._next_batch()
+
+    def close(self):
+        """Stops the flusher and writes out what is left."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            'depth': len(self._items),
+            'max_size': self.max_size,
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency
+        }